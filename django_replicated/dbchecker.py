@@ -1,9 +1,13 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import copy
 import logging
+import math
 import socket
+import time
 from functools import partial
+from threading import local
 
 import django
 from django.conf import settings
@@ -18,14 +22,189 @@ else:
     def get_cache(alias): return caches[alias]
 
 
+from django.core.signals import request_finished
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:  # django 1.7
+    from django.test.signals import setting_changed
+
 from .utils import get_object_name
 
 
 log = logging.getLogger(__name__)
 
-cache = get_cache(settings.REPLICATED_CACHE_BACKEND or DEFAULT_CACHE_ALIAS)
+# Resolved on first use, so importing this module doesn't do network calls
+_hostname = None
+_cache = None
+
+# Probe connections of the current thread: alias -> connection
+_probes = local()
+
+DEAD_MARK = 'dead'
+
+
+def get_hostname():
+    '''
+    Node identity used in cache keys: REPLICATED_NODE_NAME or FQDN.
+    '''
+    global _hostname
+
+    if _hostname is None:
+        _hostname = settings.REPLICATED_NODE_NAME or socket.getfqdn()
+    return _hostname
+
+
+def get_state_cache():
+    '''
+    Cache backend to store database state.
+    '''
+    global _cache
+
+    if _cache is None:
+        _cache = get_cache(settings.REPLICATED_CACHE_BACKEND or DEFAULT_CACHE_ALIAS)
+    return _cache
+
+
+def get_cache_key(name, db_name, node=None):
+    return ':'.join((node or get_hostname(), name, db_name))
+
+
+def is_marked_dead(checker, db_name, node=None):
+    '''
+    Whether the last check of a database failed less than
+    cache_seconds ago, without checking it. Checks made by another
+    node are looked up by its name.
+    '''
+    cache_key = get_cache_key(get_object_name(checker), db_name, node)
+    return get_state_cache().get(cache_key) == DEAD_MARK
+
+
+def get_cached_lag(db_name, node=None):
+    '''
+    Replication lag stored by the last get_lag call or None.
+    '''
+    lag = get_state_cache().get(get_cache_key('replication_lag', db_name, node))
+    return None if lag == 'unknown' else lag
+
+
+def reset_lazy_state(setting, **kwargs):
+    global _hostname, _cache
+
+    if setting == 'REPLICATED_NODE_NAME':
+        _hostname = None
+    elif setting in ('REPLICATED_CACHE_BACKEND', 'CACHES'):
+        _cache = None
+
+
+setting_changed.connect(reset_lazy_state)
+
+
+def get_probe_options(vendor, options):
+    '''
+    Connection options of a probe connection with short connect
+    and statement timeouts.
+    '''
+    connect_timeout = settings.REPLICATED_PROBE_CONNECT_TIMEOUT
+    statement_timeout = settings.REPLICATED_PROBE_STATEMENT_TIMEOUT
+    options = dict(options)
+
+    if vendor == 'mysql':
+        options['connect_timeout'] = int(math.ceil(connect_timeout))
+        options['read_timeout'] = int(math.ceil(statement_timeout))
+        options['write_timeout'] = int(math.ceil(statement_timeout))
+
+    elif vendor in ('postgresql', 'postgresql_psycopg2', 'postgis'):
+        options['connect_timeout'] = int(math.ceil(connect_timeout))
+        options['options'] = ' '.join(filter(None, (
+            options.get('options'),
+            '-c statement_timeout=%d' % (statement_timeout * 1000),
+        )))
+
+    elif vendor == 'sqlite':
+        options['timeout'] = statement_timeout
+
+    return options
+
+
+def get_probe_connection(db_name):
+    '''
+    Connection used by checks instead of the one used by requests.
+    It has short timeouts and is reused by checks in the same thread
+    for CONN_MAX_AGE of the database like request connections.
+    '''
+    if not settings.REPLICATED_PROBE_CONNECTIONS:
+        return connections[db_name]
+
+    probes = getattr(_probes, 'connections', None)
+    if probes is None:
+        probes = _probes.connections = {}
+
+    try:
+        probe = probes[db_name]
+    except KeyError:
+        pass
+    else:
+        # Processes without requests don't get request_finished
+        close_obsolete_probe(probe)
+        return probe
+
+    probe = probes[db_name] = create_probe_connection(db_name)
+    return probe
+
+
+def create_probe_connection(db_name):
+    '''
+    New connection to a database with short timeouts, should be
+    closed by the caller.
+    '''
+    connection = connections[db_name]
+    settings_dict = copy.deepcopy(connection.settings_dict)
+    settings_dict['ATOMIC_REQUESTS'] = False
+    settings_dict['AUTOCOMMIT'] = True
+    settings_dict['OPTIONS'] = get_probe_options(connection.vendor, settings_dict.get('OPTIONS', {}))
+
+    return connection.__class__(settings_dict, db_name)
+
+
+def close_probe_connection(db_name):
+    probe = getattr(_probes, 'connections', {}).pop(db_name, None)
+    if probe is None:
+        return
+
+    try:
+        probe.close()
+    except Exception:
+        log.debug('Error closing probe connection: %s', db_name, exc_info=True)
 
-hostname = socket.getfqdn()
+
+def close_probe_connections():
+    for db_name in list(getattr(_probes, 'connections', {})):
+        close_probe_connection(db_name)
+
+
+def close_obsolete_probe(probe):
+    '''
+    Closes a probe connection older than CONN_MAX_AGE of its database.
+    Usability is not checked here, is_alive reconnects unusable ones.
+    '''
+    if probe.close_at is not None and time.time() >= probe.close_at:
+        try:
+            probe.close()
+        except Exception:
+            log.debug('Error closing probe connection: %s', probe.alias, exc_info=True)
+
+
+def close_old_probe_connections(**kwargs):
+    '''
+    Closes probe connections of the current thread older than
+    CONN_MAX_AGE, as Django does with request connections.
+    '''
+    for probe in list(getattr(_probes, 'connections', {}).values()):
+        close_obsolete_probe(probe)
+
+
+request_finished.connect(close_old_probe_connections)
 
 
 def is_alive(connection):
@@ -40,6 +219,10 @@ def is_alive(connection):
             connection.connection.ping()
     else:
         log.debug('Get cursor for db: %s', connection.alias)
+        # Probe connections are reused, getting a cursor from an open
+        # connection doesn't reach the database
+        if connection.connection is not None and not connection.is_usable():
+            connection.close()
         with connection.cursor():
             pass
 
@@ -64,17 +247,118 @@ def is_writable(connection):
     return result
 
 
+def parse_mysql_position(log_file, position):
+    # mysql-bin.000123 -> 123
+    return (int(log_file.rsplit('.', 1)[-1]) << 32) + int(position)
+
+
+def parse_pg_lsn(lsn):
+    # 16/B374D848 -> 0x16B374D848
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def replication_position(connection):
+    '''
+    Position in the replication stream of the master a database
+    has applied, as a comparable integer. None if unknown.
+    '''
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute('SHOW SLAVE STATUS')
+            row = cursor.fetchone()
+            if row is not None:
+                status = dict(zip([column[0] for column in cursor.description], row))
+                return parse_mysql_position(status['Relay_Master_Log_File'], status['Exec_Master_Log_Pos'])
+
+            cursor.execute('SHOW MASTER STATUS')
+            row = cursor.fetchone()
+            if row is not None:
+                return parse_mysql_position(row[0], row[1])
+
+        elif connection.vendor in ('postgresql', 'postgresql_psycopg2', 'postgis'):
+            if getattr(connection, 'pg_version', 0) >= 100000:
+                replay, current = 'pg_last_wal_replay_lsn()', 'pg_current_wal_lsn()'
+            else:
+                replay, current = 'pg_last_xlog_replay_location()', 'pg_current_xlog_location()'
+            cursor.execute(
+                'SELECT CASE WHEN pg_is_in_recovery() THEN %s ELSE %s END::text' % (replay, current)
+            )
+            lsn = cursor.fetchone()[0]
+            if lsn is not None:
+                return parse_pg_lsn(lsn)
+
+    return None
+
+
+def replication_lag(connection):
+    '''
+    Replication lag of a slave in seconds, 0 for a master and None if
+    replication is broken.
+    '''
+    result = 0.0
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute('SHOW SLAVE STATUS')
+            row = cursor.fetchone()
+            if row is not None:
+                columns = [column[0] for column in cursor.description]
+                lag = dict(zip(columns, row)).get('Seconds_Behind_Master')
+                result = None if lag is None else float(lag)
+
+        elif connection.vendor in ('postgresql', 'postgresql_psycopg2', 'postgis'):
+            # Replay timestamp alone grows on a caught up slave of an idle master
+            if getattr(connection, 'pg_version', 0) >= 100000:
+                caught_up = 'pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()'
+            else:
+                caught_up = 'pg_last_xlog_receive_location() = pg_last_xlog_replay_location()'
+            cursor.execute(
+                'SELECT CASE WHEN NOT pg_is_in_recovery() OR %s THEN 0 '
+                'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END' % caught_up
+            )
+            lag = cursor.fetchone()[0]
+            result = None if lag is None else float(lag)
+
+    return result
+
+
+def get_lag(db_name, cache_seconds=None):
+    '''
+    Replication lag of a database in seconds, cached for cache_seconds.
+    None if lag is unknown.
+    '''
+    cache = get_state_cache()
+    cache_key = get_cache_key('replication_lag', db_name)
+
+    if cache_seconds:
+        lag = cache.get(cache_key)
+        if lag is not None:
+            return None if lag == 'unknown' else lag
+
+    try:
+        lag = replication_lag(get_probe_connection(db_name))
+    except Exception:
+        log.exception('Error getting replication lag: %s', db_name)
+        close_probe_connection(db_name)
+        lag = None
+
+    log.debug('Replication lag %s: %s', db_name, lag)
+
+    if cache_seconds:
+        cache.set(cache_key, 'unknown' if lag is None else lag, cache_seconds)
+
+    return lag
+
+
 def check_db(checker, db_name, cache_seconds=None, number_of_tries=1, force=False):
     assert number_of_tries >= 1, 'Number of tries must be >= 1.'
 
-    connection = connections[db_name]
-
+    cache = get_state_cache()
     checker_name = get_object_name(checker)
-    cache_key = ':'.join((hostname, checker_name, db_name))
-    dead_mark = 'dead'
+    cache_key = get_cache_key(checker_name, db_name)
 
     if not force and cache_seconds is not None:
-        is_dead = cache.get(cache_key) == dead_mark
+        is_dead = cache.get(cache_key) == DEAD_MARK
 
         if is_dead:
             log.debug(
@@ -98,11 +382,13 @@ def check_db(checker, db_name, cache_seconds=None, number_of_tries=1, force=Fals
         )
 
         try:
-            result = checker(connection)
+            result = checker(get_probe_connection(db_name))
         except Exception:
             if count == number_of_tries:
                 log.exception('Error verifying %s: %s', checker_name, db_name)
 
+            # Don't reuse a connection left in unknown state
+            close_probe_connection(db_name)
             result = False
 
         log.debug(
@@ -114,7 +400,7 @@ def check_db(checker, db_name, cache_seconds=None, number_of_tries=1, force=Fals
             break
 
     if not result and cache_seconds is not None:
-        cache.set(cache_key, dead_mark, cache_seconds)
+        cache.set(cache_key, DEAD_MARK, cache_seconds)
 
     return result
 
@@ -16,14 +16,109 @@ Usage:
     @use_slave
     def my_view(request, ...):
         # same with slave connection
+
+    @use_state(forced_state='slave', max_staleness=30)
+    def my_view(request, ...):
+        # slaves lagging more than 30 seconds are not used,
+        # master is used if there is no such slave
+
+Long running processes (workers, management commands) can spread reads
+across all alive slaves instead of sticking to a single one:
+
+    from django_replicated.decorators import distribute_reads
+
+    @distribute_reads
+    def my_task(...):
+        # every read uses the next alive slave
+
+    with distribute_reads(check_interval=30):
+        ...
+
+Long scans (exports, large .iterator() reads) can be sent to dedicated
+export slaves, away from slaves serving interactive requests:
+
+    from django_replicated.decorators import export_reads
+
+    @export_reads
+    def export_view(request, ...):
+        ...
 '''
 from __future__ import unicode_literals
 
+try:
+    from contextlib import ContextDecorator
+except ImportError:  # python 2
+    from django.utils.decorators import ContextDecorator
+
+from django.conf import settings
 from django.utils.decorators import decorator_from_middleware_with_args
 
+from . import querycache
 from .middleware import ReplicationMiddleware
+from .utils import routers
 
 
 use_state = decorator_from_middleware_with_args(ReplicationMiddleware)
 use_master = use_state(forced_state='master')
 use_slave = use_state(forced_state='slave')
+
+
+class DistributedReads(ContextDecorator):
+    '''
+    Switches to slave state and routes every read to the next alive
+    slave in round-robin order. Alive slaves are checked again every
+    check_interval seconds (REPLICATED_DISTRIBUTE_CHECK_INTERVAL by
+    default).
+
+    Consecutive reads may hit different slaves, so they are not
+    guaranteed to see the same replication position.
+
+    Writes go to master without raising an error even though the state
+    is slave, but reads following them are not guaranteed to see them.
+    They are recorded for the query cache on exit.
+    Such reads should switch to master with ``routers.use_state('master')``
+    and ``routers.revert()``.
+    '''
+    def __init__(self, check_interval=None):
+        self.check_interval = check_interval
+
+    def __enter__(self):
+        routers.use_state('slave')
+        routers.enable_distribution(self.check_interval)
+        return self
+
+    def __exit__(self, *exc_info):
+        tables = routers.disable_distribution()
+        if settings.REPLICATED_QUERY_CACHE and tables:
+            # There is no middleware to record writes of workers
+            querycache.record_writes_on_commit(tables)
+        routers.revert()
+
+
+def distribute_reads(check_interval=None):
+    # Bare decorator: @distribute_reads
+    if callable(check_interval):
+        return DistributedReads()(check_interval)
+    return DistributedReads(check_interval)
+
+
+class ExportReads(ContextDecorator):
+    '''
+    Switches to slave state and routes reads to export slaves
+    (REPLICATED_EXPORT_SLAVES or EXPORT_SLAVES of a group).
+    '''
+    def __enter__(self):
+        routers.use_state('slave')
+        routers.enable_export()
+        return self
+
+    def __exit__(self, *exc_info):
+        routers.disable_export()
+        routers.revert()
+
+
+def export_reads(func=None):
+    # Bare decorator: @export_reads
+    if callable(func):
+        return ExportReads()(func)
+    return ExportReads()
@@ -0,0 +1,209 @@
+# coding: utf-8
+from __future__ import division, unicode_literals
+
+import json
+import threading
+import time
+
+import django
+from django import db
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from ... import dbchecker
+from ...router import ReplicationRouter
+
+
+def percentile(values, share):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def benchmark(db_name, queries, concurrency):
+    '''
+    Runs queries trivial queries against a database in concurrency
+    threads, each thread using its own connection with probe timeouts.
+    '''
+    latencies = []
+    errors = []
+
+    def worker(count):
+        connection = dbchecker.create_probe_connection(db_name)
+        sql = 'SELECT 1 FROM DUAL' if connection.vendor == 'oracle' else 'SELECT 1'
+        try:
+            for _ in range(count):
+                began = time.time()
+                try:
+                    with connection.cursor() as cursor:
+                        cursor.execute(sql)
+                        cursor.fetchone()
+                except Exception as e:
+                    errors.append(e)
+                else:
+                    latencies.append(time.time() - began)
+        finally:
+            connection.close()
+
+    counts = [queries // concurrency + (1 if i < queries % concurrency else 0) for i in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(count,)) for count in counts if count]
+
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    return {
+        'queries': len(latencies),
+        'errors': len(errors),
+        'last_error': str(errors[-1]) if errors else None,
+        'qps': len(latencies) / elapsed if elapsed else None,
+        'min': min(latencies) if latencies else None,
+        'avg': sum(latencies) / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'max': max(latencies) if latencies else None,
+    }
+
+
+def make_options(arguments):
+    '''
+    optparse options from argparse arguments of a command.
+    '''
+    from optparse import make_option
+
+    for args, kwargs in arguments:
+        if 'type' in kwargs:
+            kwargs = dict(kwargs, type=kwargs['type'].__name__)
+        yield make_option(*args, **kwargs)
+
+
+class Command(BaseCommand):
+    help = (
+        'Shows the state of replicated databases as seen by the router '
+        'and benchmarks how fast every database answers.'
+    )
+
+    arguments = (
+        (('--queries',), dict(type=int, default=100,
+                              help='Number of benchmark queries per database, 0 to skip benchmark')),
+        (('--concurrency',), dict(type=int, default=4,
+                                  help='Number of concurrent connections per database')),
+        (('--no-lag',), dict(action='store_false', dest='lag', default=True,
+                             help='Show cached replication lag instead of measuring it')),
+        (('--node',), dict(default=None,
+                           help='Name of the node whose dead marks and cached lag are shown, '
+                                'REPLICATED_NODE_NAME or FQDN of this host by default')),
+        (('--json',), dict(action='store_true', dest='json', default=False,
+                           help='Output as JSON')),
+    )
+
+    if django.VERSION < (1, 8):
+        # Commands are parsed with optparse, add_arguments isn't used
+        option_list = BaseCommand.option_list + tuple(make_options(arguments))
+
+    def add_arguments(self, parser):
+        for args, kwargs in self.arguments:
+            parser.add_argument(*args, **kwargs)
+
+    def get_databases(self):
+        '''
+        (alias, group, role) of every database known to the router.
+        '''
+        for router in db.router.routers:
+            if isinstance(router, ReplicationRouter):
+                result = []
+                for group in router.groups:
+                    result.append((group.master, group.name, 'master'))
+                    result.extend(
+                        (slave, group.name, 'slave')
+                        for slave in group.slaves if slave != group.master
+                    )
+                    result.extend(
+                        (slave, group.name, 'export')
+                        for slave in group.export_slaves if slave not in group.slaves
+                    )
+                return result
+
+        return [(alias, None, None) for alias in connections]
+
+    def get_status(self, db_name, group, role, measure_lag, node):
+        if measure_lag:
+            lag = dbchecker.get_lag(db_name)
+        else:
+            lag = dbchecker.get_cached_lag(db_name, node)
+
+        return {
+            'alias': db_name,
+            'group': group,
+            'role': role,
+            'node': node,
+            'dead': dbchecker.is_marked_dead(dbchecker.is_alive, db_name, node),
+            'read_only': dbchecker.is_marked_dead(dbchecker.is_writable, db_name, node),
+            'lag': lag,
+        }
+
+    def handle(self, *args, **options):
+        node = options.get('node') or dbchecker.get_hostname()
+        databases = self.get_databases()
+        statuses = [
+            self.get_status(db_name, group, role, options['lag'], node)
+            for db_name, group, role in databases
+        ]
+
+        if options['queries'] > 0:
+            results = {}
+
+            def run(db_name):
+                results[db_name] = benchmark(db_name, options['queries'], max(1, options['concurrency']))
+
+            threads = [threading.Thread(target=run, args=(db_name,)) for db_name, _, _ in databases]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            for status in statuses:
+                status['benchmark'] = results[status['alias']]
+
+        if options['json']:
+            self.stdout.write(json.dumps(statuses, indent=2, sort_keys=True))
+        else:
+            self.write_table(statuses)
+
+    def write_table(self, statuses):
+        def seconds(value):
+            return '-' if value is None else '%.2fms' % (value * 1000)
+
+        header = ['alias', 'group', 'role', 'state', 'lag']
+        with_benchmark = any('benchmark' in status for status in statuses)
+        if with_benchmark:
+            header.extend(['qps', 'avg', 'p95', 'max', 'errors'])
+
+        rows = [header]
+        for status in statuses:
+            if status['dead']:
+                state = 'dead'
+            elif status['read_only']:
+                state = 'read-only'
+            else:
+                state = 'alive'
+            row = [
+                status['alias'], status['group'] or '-', status['role'] or '-', state,
+                '-' if status['lag'] is None else '%.1fs' % status['lag'],
+            ]
+            if with_benchmark:
+                result = status['benchmark']
+                row.extend([
+                    '-' if result['qps'] is None else '%.1f' % result['qps'],
+                    seconds(result['avg']), seconds(result['p95']), seconds(result['max']),
+                    str(result['errors']),
+                ])
+            rows.append(row)
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        for row in rows:
+            self.stdout.write('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
@@ -4,9 +4,15 @@ from __future__ import unicode_literals
 import inspect
 import logging
 import fnmatch
+import threading
 import types
 from functools import partial
 
+try:
+    from collections.abc import Set
+except ImportError:  # python 2
+    from collections import Set
+
 from django import db
 from django.conf import settings
 from django.utils import six, functional
@@ -23,13 +29,21 @@ except ImportError:
         def __init__(self, get_response=None):
             pass
 
-from . import dbchecker
+from . import dbchecker, querycache
 from .utils import routers, get_object_name
 
 
 log = logging.getLogger(__name__)
 
 
+def get_state_router():
+    '''
+    Router keeping the routing state, resolved once per middleware hook
+    instead of looking it up for every call.
+    '''
+    return routers.get_router('state')
+
+
 class ReplicationMiddleware(MiddlewareMixin):
     '''
     Middleware for automatically switching routing state to
@@ -45,12 +59,15 @@ class ReplicationMiddleware(MiddlewareMixin):
     updated to match master. Thus first redirect after POST is pointed to
     master connection even if it only GETs data.
     '''
-    def __init__(self, get_response=None, forced_state=None):
+    def __init__(self, get_response=None, forced_state=None, max_staleness=None):
         super(ReplicationMiddleware, self).__init__(get_response=get_response)
 
         self.forced_state = forced_state
+        self.max_staleness = max_staleness
 
     def process_request(self, request):
+        max_staleness = self.max_staleness
+
         if self.forced_state is not None:
             state = self.forced_state
             log.debug('state by .forced_state attr: %s', state)
@@ -64,32 +81,33 @@ class ReplicationMiddleware(MiddlewareMixin):
 
             log.debug('state by request method: %s', state)
 
-            state = self.check_state_override(request, state)
+            state, max_staleness = self.get_override(request, state)
             log.debug('state after override: %s', state)
 
             log.debug('init state: %s', state)
-        routers.init(state)
+        router = get_state_router()
+        router.init(state)
+
+        if max_staleness is not None and state == 'slave':
+            log.debug('max staleness: %s', max_staleness)
+            router.set_max_staleness(max_staleness)
+
+        if settings.REPLICATED_FORCE_MASTER_TABLES and state == 'slave':
+            tables = self.get_force_master_tables(request)
+            if tables:
+                log.debug('master tables by cookie: %s', ', '.join(tables))
+                router.set_master_tables(tables)
 
     def set_non_atomic_dbs(self, view):
         if isinstance(view, types.MethodType):
             view = six.get_method_function(view)
 
-        default_attr = '_replicated_view_default_non_atomic_dbs'
-        default_set = getattr(view, default_attr, None)
-        # If default_set is None then this first request. Set default.
-        if default_set is None:
-            view_set = getattr(view, '_non_atomic_requests', set())
-            setattr(view, default_attr, view_set)
-            default_set = view_set
-
-        all_allowed_aliases = routers.all_allowed_aliases
-        # If state master db_for_read() == db_for_write()
-        current_alias = routers.db_for_read()
-        not_used_aliases = set(
-            a for a in all_allowed_aliases
-            if a != current_alias
-        )
-        view._non_atomic_requests = not_used_aliases | default_set
+        non_atomic_dbs = getattr(view, '_non_atomic_requests', None)
+        if not isinstance(non_atomic_dbs, NonAtomicDbs):
+            non_atomic_dbs = NonAtomicDbs.install(view)
+
+        # Groups not used yet are not resolved to avoid checking their slaves
+        non_atomic_dbs.activate(*get_state_router().chosen_aliases())
 
     def process_view(self, request, view, *args):
         if settings.REPLICATED_MANAGE_ATOMIC_REQUESTS:
@@ -97,7 +115,15 @@ class ReplicationMiddleware(MiddlewareMixin):
 
     def process_response(self, request, response):
         self.handle_redirect_after_write(request, response)
-        routers.reset()
+
+        router = get_state_router()
+        if settings.REPLICATED_QUERY_CACHE:
+            tables = router.written_tables()
+            if tables:
+                # Inside the transaction of the view when used as a decorator
+                querycache.record_writes_on_commit(tables)
+
+        router.reset()
         return response
 
     def check_state_override(self, request, state):
@@ -105,13 +131,23 @@ class ReplicationMiddleware(MiddlewareMixin):
         Used to check if a web request should use a master or slave
         database besides default choice.
         '''
+        return self.get_override(request, state)[0]
+
+    def get_override(self, request, state):
+        '''
+        Same as check_state_override, also returns max staleness of
+        slaves set by the override or None.
+        '''
         if request.COOKIES.get(settings.REPLICATED_FORCE_MASTER_COOKIE_NAME) == 'true':
-            return 'master'
+            return 'master', None
 
+        max_staleness = None
         override_state = self.get_state_override(request)
+        if isinstance(override_state, (tuple, list)):
+            override_state, max_staleness = override_state
         if override_state is not None:
             state = override_state
-        return state
+        return state, max_staleness
 
     def get_state_override(self, request):
         overrides = settings.REPLICATED_VIEWS_OVERRIDES
@@ -138,6 +174,34 @@ class ReplicationMiddleware(MiddlewareMixin):
         else:
             return match.url_name == lookup_view
 
+    def get_force_master_tables(self, request):
+        '''
+        Tables written by a previous request stored in the cookie, not
+        more than REPLICATED_FORCE_MASTER_MAX_TABLES.
+        '''
+        value = request.COOKIES.get(settings.REPLICATED_FORCE_MASTER_COOKIE_NAME)
+        if not value or value == 'true':
+            return []
+        tables = [table for table in value.split(',') if table]
+        return tables[:settings.REPLICATED_FORCE_MASTER_MAX_TABLES]
+
+    def get_force_master_value(self):
+        '''
+        Value of the read-after-write cookie: 'true' to use master for
+        the whole next request or a list of written tables of models when
+        REPLICATED_FORCE_MASTER_TABLES is enabled. Falls back to 'true'
+        if no such tables were recorded, e.g. after raw SQL writes, or
+        if there are more than REPLICATED_FORCE_MASTER_MAX_TABLES of them.
+        '''
+        if not settings.REPLICATED_FORCE_MASTER_TABLES:
+            return 'true'
+
+        groups_by_table = routers.get_groups_by_table()
+        tables = [table for table in routers.written_tables() if table in groups_by_table]
+        if not tables or len(tables) > settings.REPLICATED_FORCE_MASTER_MAX_TABLES:
+            return 'true'
+        return ','.join(sorted(tables))
+
     def handle_redirect_after_write(self, request, response):
         '''
         Sets a flag using cookies to redirect requests happening after
@@ -145,22 +209,88 @@ class ReplicationMiddleware(MiddlewareMixin):
         request will use master database. This avoids situation when
         replicas lagging behind on updates a little.
         '''
+        value = None
         force_master_codes = settings.REPLICATED_FORCE_MASTER_COOKIE_STATUS_CODES
         if response.status_code in force_master_codes and routers.state() == 'master':
-            log.debug('set force master cookie for %s', request.path)
-            self.set_force_master_cookie(response)
+            value = self.get_force_master_value()
+
+        if value:
+            log.debug('set force master cookie for %s: %s', request.path, value)
+            self.set_force_master_cookie(response, value)
         else:
             if settings.REPLICATED_FORCE_MASTER_COOKIE_NAME in request.COOKIES:
                 response.delete_cookie(settings.REPLICATED_FORCE_MASTER_COOKIE_NAME)
 
-    def set_force_master_cookie(self, response):
+    def set_force_master_cookie(self, response, value='true'):
         '''
         Use it to explicitly use master on next request to your app.
         '''
-        response.set_cookie(settings.REPLICATED_FORCE_MASTER_COOKIE_NAME, 'true',
+        response.set_cookie(settings.REPLICATED_FORCE_MASTER_COOKIE_NAME, value,
                             max_age=settings.REPLICATED_FORCE_MASTER_COOKIE_MAX_AGE)
 
 
+class NonAtomicDbs(Set):
+    '''
+    Replacement for ``_non_atomic_requests`` attribute of a view used
+    when ``REPLICATED_MANAGE_ATOMIC_REQUESTS`` is enabled.
+
+    Sets of aliases which should not be wrapped in a transaction are
+    computed once per combination of chosen aliases. The set in effect is kept per thread,
+    so the view object itself is not changed on every request.
+    '''
+    _install_lock = threading.Lock()
+
+    def __init__(self, default):
+        self.default = frozenset(default)
+        self._by_aliases = {}
+        self._local = threading.local()
+
+    @classmethod
+    def install(cls, view):
+        with cls._install_lock:
+            non_atomic_dbs = getattr(view, '_non_atomic_requests', None)
+            if not isinstance(non_atomic_dbs, cls):
+                non_atomic_dbs = cls(non_atomic_dbs or ())
+                view._replicated_view_default_non_atomic_dbs = non_atomic_dbs.default
+                view._non_atomic_requests = non_atomic_dbs
+        return non_atomic_dbs
+
+    def for_aliases(self, *aliases):
+        try:
+            return self._by_aliases[aliases]
+        except KeyError:
+            result = self.default | frozenset(
+                a for a in routers.all_allowed_aliases
+                if a not in aliases
+            )
+            self._by_aliases[aliases] = result
+            return result
+
+    def activate(self, *aliases):
+        self._local.current = self.for_aliases(*aliases)
+
+    @property
+    def current(self):
+        return getattr(self._local, 'current', self.default)
+
+    def add(self, alias):
+        # Support for transaction.non_atomic_requests applied on top
+        self.default = self.default | frozenset([alias])
+        self._by_aliases = {}
+
+    def __contains__(self, alias):
+        return alias in self.current
+
+    def __iter__(self):
+        return iter(self.current)
+
+    def __len__(self):
+        return len(self.current)
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, sorted(self.current))
+
+
 class ReadOnlyMiddleware(MiddlewareMixin):
     def process_request(self, request):
         request.service_is_readonly = functional.SimpleLazyObject(self.is_service_read_only)
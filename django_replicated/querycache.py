@@ -0,0 +1,197 @@
+# coding: utf-8
+'''
+Replication consistent cache of query results.
+
+Results of reads in slave state are cached per query and replication group
+together with the replication position of the slave they were read from.
+Writes recorded by the router store the position of the master after them
+for every written table. A cached result is used only while there were no
+writes to its tables after its position, so it is never staler than what
+a slave would return.
+
+Usage:
+
+    REPLICATED_QUERY_CACHE = True
+
+    from django_replicated.querycache import cached_query
+
+    items = cached_query(Item.objects.filter(category=category))
+
+Writes are recorded by ReplicationMiddleware at the end of a request, after
+the transaction of the request is committed, and by distribute_reads on exit.
+Other writes made outside of requests should be recorded explicitly after
+commit:
+
+    from django_replicated.querycache import record_writes
+
+    record_writes(routers.written_tables())
+
+Only tables from FROM and JOIN clauses are tracked automatically, tables
+used in subqueries or raw SQL should be passed in ``tables``.
+'''
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+import time
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+
+from . import dbchecker
+from .utils import routers
+
+
+log = logging.getLogger(__name__)
+
+KEY_PREFIX = 'django_replicated:query'
+
+# Seconds a lock of write positions is held at most
+LOCK_TIMEOUT = 2
+LOCK_RETRY_DELAY = 0.005
+
+
+def get_position(db_name):
+    try:
+        return dbchecker.replication_position(dbchecker.get_probe_connection(db_name))
+    except Exception:
+        log.exception('Error getting replication position: %s', db_name)
+        dbchecker.close_probe_connection(db_name)
+        return None
+
+
+def get_write_key(group_name, table):
+    return ':'.join((KEY_PREFIX, 'write', group_name, table))
+
+
+def get_lock_key(group_name):
+    return ':'.join((KEY_PREFIX, 'lock', group_name))
+
+
+def acquire_lock(cache, lock_key):
+    '''
+    Waits for a lock stored in the cache, False if it is not released
+    in LOCK_TIMEOUT seconds.
+    '''
+    deadline = time.time() + LOCK_TIMEOUT
+    while not cache.add(lock_key, 1, LOCK_TIMEOUT):
+        if time.time() >= deadline:
+            return False
+        time.sleep(LOCK_RETRY_DELAY)
+    return True
+
+
+def get_result_key(group_name, sql, params):
+    digest = hashlib.md5(('%s\n%r' % (sql, params)).encode('utf-8')).hexdigest()
+    return ':'.join((KEY_PREFIX, 'result', group_name, digest))
+
+
+def record_writes(tables):
+    '''
+    Stores current position of masters as the last write position of
+    tables, invalidating cached results read before it.
+    '''
+    cache = dbchecker.get_state_cache()
+    # Outlive any result read before the write, see cached_query
+    timeout = 2 * settings.REPLICATED_QUERY_CACHE_TIMEOUT
+
+    for group, group_tables in get_table_groups(tables).items():
+        position = get_position(group.master)
+        keys = [get_write_key(group.name, table) for table in group_tables]
+
+        if position is None:
+            # Unknown position: results can't be validated, drop them
+            log.debug('No replication position of %s, invalidating %s', group.master, ', '.join(group_tables))
+            position = float('inf')
+
+        # Write positions must only grow, a concurrent writer with an older
+        # position must not overwrite a newer one
+        lock_key = get_lock_key(group.name)
+        locked = acquire_lock(cache, lock_key)
+        if not locked:
+            log.warning('Write positions of %s are locked for too long, updating anyway', group.name)
+
+        try:
+            current = cache.get_many(keys)
+            cache.set_many(
+                dict((key, max(position, current.get(key, position))) for key in keys),
+                timeout,
+            )
+        finally:
+            if locked:
+                cache.delete(lock_key)
+
+
+def record_writes_on_commit(tables):
+    '''
+    Records writes when the current transaction of their master is
+    committed, immediately outside of a transaction. The position of a
+    master taken before commit would not include the writes.
+    '''
+    on_commit = getattr(transaction, 'on_commit', None)
+
+    for group, group_tables in get_table_groups(tables).items():
+        if on_commit is None:  # django < 1.9
+            record_writes(group_tables)
+        else:
+            on_commit(partial(record_writes, group_tables), using=group.master)
+
+
+def get_table_groups(tables):
+    groups = {}
+    for table in sorted(tables):
+        groups.setdefault(routers.get_table_group(table), []).append(table)
+    return groups
+
+
+def get_tables(queryset, compiler):
+    tables = set([queryset.model._meta.db_table])
+    for join in compiler.query.alias_map.values():
+        tables.add(join.table_name)
+    return tables
+
+
+def cached_query(queryset, timeout=None, tables=()):
+    '''
+    Evaluates a queryset into a list using cached result if it is
+    consistent with the replication position of slaves.
+    '''
+    if not settings.REPLICATED_QUERY_CACHE or routers.state() != 'slave':
+        return list(queryset)
+
+    db_name = queryset.db
+    group = routers.get_group(queryset.model)
+    if db_name == group.master:
+        return list(queryset)
+
+    compiler = queryset.query.get_compiler(using=db_name)
+    try:
+        sql, params = compiler.as_sql()
+    except Exception:
+        # e.g. EmptyResultSet
+        return list(queryset)
+
+    tables = get_tables(queryset, compiler) | set(tables)
+    cache = dbchecker.get_state_cache()
+    result_key = get_result_key(group.name, sql, params)
+    write_keys = dict((get_write_key(group.name, table), table) for table in tables)
+
+    values = cache.get_many([result_key] + list(write_keys))
+    entry = values.pop(result_key, None)
+    if entry is not None:
+        position, result = entry
+        if all(write <= position for write in values.values()):
+            log.debug('Cached result of %s at %s', ', '.join(sorted(tables)), position)
+            return result
+
+    # Position is taken before reading, so the result is at least as new
+    position = get_position(db_name)
+    result = list(queryset)
+
+    if position is not None:
+        max_timeout = settings.REPLICATED_QUERY_CACHE_TIMEOUT
+        timeout = max_timeout if timeout is None else min(timeout, max_timeout)
+        cache.set(result_key, (position, result), timeout)
+
+    return result
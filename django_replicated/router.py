@@ -1,18 +1,98 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import itertools
 import logging
 import random
-from threading import local
+import time
+from threading import Lock, local
 
 log = logging.getLogger(__name__)
 
 
+DEFAULT_GROUP = 'default'
+
+BALANCING_RANDOM = 'random'
+BALANCING_ORDERED = 'ordered'
+
+
+class ReplicationGroup(object):
+    '''
+    Master database with its slaves.
+
+    Models are routed to a group by their app label or by
+    "app_label.ModelName". Models not matched by any group are routed
+    to the default one.
+    '''
+    options = (
+        'MASTER', 'SLAVES', 'DOWNTIME', 'BALANCING', 'APPS', 'MODELS',
+        'EXPORT_SLAVES', 'EXPORT_DOWNTIME',
+    )
+
+    def __init__(self, name, master, slaves=None, downtime=60,
+                 balancing=BALANCING_RANDOM, apps=(), models=(),
+                 export_slaves=(), export_downtime=None):
+        from django.core.exceptions import ImproperlyConfigured
+
+        if balancing not in (BALANCING_RANDOM, BALANCING_ORDERED):
+            raise ImproperlyConfigured(
+                'Unknown balancing "%s" of replication group "%s"' % (balancing, name)
+            )
+
+        self.name = name
+        self.master = master
+        self.slaves = list(slaves or [master])
+        self.downtime = downtime
+        self.balancing = balancing
+        self.apps = frozenset(apps)
+        self.models = frozenset(model.lower() for model in models)
+        # Slaves dedicated to long running streaming reads
+        self.export_slaves = list(export_slaves)
+        self.export_downtime = downtime if export_downtime is None else export_downtime
+
+        self.aliases = [self.master] + [s for s in self.slaves if s != self.master]
+        self.aliases.extend(s for s in self.export_slaves if s not in self.aliases)
+
+    @classmethod
+    def from_settings(cls, name, config):
+        from django.core.exceptions import ImproperlyConfigured
+
+        unknown = set(config) - set(cls.options)
+        if unknown:
+            raise ImproperlyConfigured(
+                'Unknown options of replication group "%s": %s' % (name, ', '.join(sorted(unknown)))
+            )
+        if 'MASTER' not in config:
+            raise ImproperlyConfigured('Replication group "%s" has no MASTER' % name)
+
+        kwargs = dict((option.lower(), config[option]) for option in cls.options if option in config)
+        return cls(name, **kwargs)
+
+    def matches(self, model):
+        return self.matches_label(model._meta.app_label, model._meta.model_name)
+
+    def matches_label(self, app_label, model_name=None):
+        return (
+            app_label in self.apps or
+            model_name is not None and '%s.%s' % (app_label, model_name.lower()) in self.models
+        )
+
+    def ordered_slaves(self, export=False):
+        slaves = (self.export_slaves if export else self.slaves)[:]
+        if self.balancing == BALANCING_RANDOM:
+            random.shuffle(slaves)
+        return slaves
+
+    def __repr__(self):
+        return '<%s %s: %s>' % (self.__class__.__name__, self.name, ', '.join(self.aliases))
+
+
 class ReplicationRouter(object):
 
     def __init__(self):
         from django.db import DEFAULT_DB_ALIAS
         from django.conf import settings
+        from django.core.exceptions import ImproperlyConfigured
 
         self._context = local()
 
@@ -20,13 +100,63 @@ class ReplicationRouter(object):
         self.DOWNTIME = settings.REPLICATED_DATABASE_DOWNTIME
         self.SLAVES = settings.REPLICATED_DATABASE_SLAVES or [DEFAULT_DB_ALIAS]
         self.CHECK_STATE_ON_WRITE = settings.REPLICATED_CHECK_STATE_ON_WRITE
+        self.DISTRIBUTE_CHECK_INTERVAL = settings.REPLICATED_DISTRIBUTE_CHECK_INTERVAL
+        self.LAG_CACHE_SECONDS = settings.REPLICATED_LAG_CACHE_SECONDS
+        self.ZONE = settings.REPLICATED_NODE_ZONE
+        self.SATURATION_LAG = settings.REPLICATED_SATURATION_LAG
+
+        self.local_aliases = frozenset(
+            alias for alias, zone in settings.REPLICATED_DATABASE_ZONES.items()
+            if self.ZONE is not None and zone == self.ZONE
+        )
+
+        self.default_group = ReplicationGroup(
+            DEFAULT_GROUP,
+            master=self.DEFAULT_DB_ALIAS,
+            slaves=self.SLAVES,
+            downtime=self.DOWNTIME,
+            balancing=settings.REPLICATED_DATABASE_BALANCING,
+            export_slaves=settings.REPLICATED_EXPORT_SLAVES,
+            export_downtime=settings.REPLICATED_EXPORT_DOWNTIME,
+        )
+        if DEFAULT_GROUP in settings.REPLICATED_DATABASE_GROUPS:
+            raise ImproperlyConfigured(
+                'Replication group "%s" is built from REPLICATED_DATABASE_SLAVES '
+                'and can\'t be set in REPLICATED_DATABASE_GROUPS' % DEFAULT_GROUP
+            )
+        self.groups = [self.default_group] + [
+            ReplicationGroup.from_settings(name, config)
+            for name, config in sorted(settings.REPLICATED_DATABASE_GROUPS.items())
+        ]
+        self.groups_by_alias = {}
+        for group in reversed(self.groups):
+            for alias in group.aliases:
+                self.groups_by_alias[alias] = group
+        self._groups_by_model = {}
+        # Built from the app registry on first use: db_table -> group
+        self._groups_by_table = None
+
+        # Shared by all threads: group name -> (time of check, alive slaves)
+        self._alive_slaves = {}
+        self._alive_slaves_lock = Lock()
+        self._round_robin = dict((group.name, itertools.count()) for group in self.groups)
 
         self.all_allowed_aliases = [self.DEFAULT_DB_ALIAS] + self.SLAVES
+        for group in self.groups:
+            self.all_allowed_aliases.extend(
+                a for a in group.aliases if a not in self.all_allowed_aliases
+            )
 
     def reset(self):
         self._context.state_stack = []
         self._context.chosen = {}
         self._context.state_change_enabled = True
+        self._context.written_tables = set()
+        self._context.master_tables = frozenset()
+        self._context.distribution_stack = []
+        self._context.distribution_written = []
+        self._context.max_staleness = None
+        self._context.export_stack = []
         self._context.inited = True
 
     @property
@@ -39,10 +169,28 @@ class ReplicationRouter(object):
         self.reset()
         self.use_state(state)
 
-    def is_alive(self, db_name):
+    def is_alive(self, db_name, downtime=None):
         from .dbchecker import db_is_alive
 
-        return db_is_alive(db_name, self.DOWNTIME)
+        if downtime is None:
+            downtime = self.DOWNTIME
+        return db_is_alive(db_name, downtime)
+
+    def get_lag(self, db_name):
+        from .dbchecker import get_lag
+
+        return get_lag(db_name, self.LAG_CACHE_SECONDS)
+
+    def is_fresh(self, db_name, max_staleness):
+        lag = self.get_lag(db_name)
+        return lag is not None and lag <= max_staleness
+
+    def set_max_staleness(self, max_staleness):
+        '''
+        Uses only slaves lagging not more than max_staleness seconds,
+        falling back to master otherwise. None disables the check.
+        '''
+        self.context.max_staleness = max_staleness
 
     def set_state_change(self, enabled):
         self.context.state_change_enabled = enabled
@@ -73,40 +221,325 @@ class ReplicationRouter(object):
         '''
         self.context.state_stack.pop()
 
-    def db_for_write(self, *args, **kwargs):
-        if self.CHECK_STATE_ON_WRITE and self.state() != 'master':
+    def enable_distribution(self, check_interval=None):
+        '''
+        Spreads every read in slave state across alive slaves instead
+        of using one slave until reset. Requires a paired call to
+        'disable_distribution'.
+        '''
+        if check_interval is None:
+            check_interval = self.DISTRIBUTE_CHECK_INTERVAL
+        self.context.distribution_stack.append(check_interval)
+        self.context.distribution_written.append(self.written_tables())
+        return self
+
+    def disable_distribution(self):
+        '''
+        Returns tables written since the paired 'enable_distribution'
+        and forgets them, so long running processes don't accumulate them.
+        '''
+        self.context.distribution_stack.pop()
+        written_before = self.context.distribution_written.pop()
+        written = self.written_tables() - written_before
+        self.context.written_tables = set(written_before)
+        return written
+
+    def enable_export(self):
+        '''
+        Routes reads in slave state to export slaves of a group. Requires
+        a paired call to 'disable_export'.
+        '''
+        self.context.export_stack.append(True)
+        return self
+
+    def disable_export(self):
+        self.context.export_stack.pop()
+
+    def get_group(self, model=None, **hints):
+        '''
+        Replication group of a model. Without a model the group of an
+        instance from hints is used, falling back to the default group.
+        '''
+        if model is None:
+            instance = hints.get('instance')
+            if instance is None:
+                return self.default_group
+            model = instance.__class__
+
+        try:
+            return self._groups_by_model[model]
+        except KeyError:
+            pass
+
+        for group in self.groups[1:]:
+            if group.matches(model):
+                break
+        else:
+            group = self.default_group
+
+        self._groups_by_model[model] = group
+        return group
+
+    def mark_written(self, *tables):
+        '''
+        Records tables written in the current state. Used for writes
+        which are not routed by the router, e.g. raw SQL.
+        '''
+        self.context.written_tables.update(tables)
+
+    def written_tables(self):
+        return frozenset(self.context.written_tables)
+
+    def set_master_tables(self, tables):
+        '''
+        Routes reads of given tables to master in slave state. Tables of
+        unknown models are ignored.
+        '''
+        groups_by_table = self.get_groups_by_table()
+        self.context.master_tables = frozenset(table for table in tables if table in groups_by_table)
+
+    def get_groups_by_table(self):
+        '''
+        Replication groups of tables of all installed models.
+        '''
+        if self._groups_by_table is None:
+            from django.apps import apps
+
+            self._groups_by_table = dict(
+                (model._meta.db_table, self.get_group(model))
+                for model in apps.get_models(include_auto_created=True)
+            )
+        return self._groups_by_table
+
+    def get_table_group(self, table):
+        '''
+        Replication group of the model having the table, the default
+        group for tables of unknown models.
+        '''
+        return self.get_groups_by_table().get(table, self.default_group)
+
+    def db_for_write(self, model=None, **hints):
+        db_name = self.group_db_for_write(self.get_group(model, **hints))
+
+        if model is not None:
+            self.context.written_tables.add(model._meta.db_table)
+
+        return db_name
+
+    def db_for_read(self, model=None, **hints):
+        group = self.get_group(model, **hints)
+
+        if (
+            model is not None and self.state() == 'slave' and
+            model._meta.db_table in self.context.master_tables
+        ):
+            log.debug('db_for_read: %s, recently written %s', group.master, model._meta.db_table)
+            return group.master
+
+        if hints.get('export') or self.context.export_stack:
+            return self.group_db_for_export(group)
+
+        return self.group_db_for_read(group)
+
+    def group_db_for_write(self, group):
+        # Writes of long running processes distributing reads go to master
+        if self.CHECK_STATE_ON_WRITE and self.state() != 'master' and not self.context.distribution_stack:
             raise RuntimeError('Trying to access master database in slave state')
 
-        self.context.chosen['master'] = self.DEFAULT_DB_ALIAS
+        self.context.chosen[(group.name, 'master')] = group.master
 
-        log.debug('db_for_write: %s', self.DEFAULT_DB_ALIAS)
-        return self.DEFAULT_DB_ALIAS
+        log.debug('db_for_write: %s', group.master)
+        return group.master
 
-    def db_for_read(self, *args, **kwargs):
+    def group_db_for_read(self, group):
         if self.state() == 'master':
-            return self.db_for_write(*args, **kwargs)
+            return self.group_db_for_write(group)
 
-        if self.state() in self.context.chosen:
-            return self.context.chosen[self.state()]
+        if self.context.distribution_stack:
+            return self.distribute_slave(group, self.context.distribution_stack[-1])
+
+        key = (group.name, self.state())
+        if key in self.context.chosen:
+            return self.context.chosen[key]
+
+        chosen = self.choose_slave(group)
+        self.context.chosen[key] = chosen
+
+        log.debug('db_for_read: %s', chosen)
+        return chosen
+
+    def group_db_for_export(self, group):
+        '''
+        Export slave for streaming reads, falls back to the regular
+        choice if the group has no alive export slave.
+        '''
+        if self.state() == 'master' or not group.export_slaves:
+            return self.group_db_for_read(group)
 
-        slaves = self.SLAVES[:]
-        random.shuffle(slaves)
+        key = (group.name, 'export')
+        if key in self.context.chosen:
+            return self.context.chosen[key]
 
-        for slave in slaves:
-            if self.is_alive(slave):
+        for slave in self.prefer_local(group.ordered_slaves(export=True)):
+            if self.is_alive(slave, group.export_downtime):
                 chosen = slave
                 break
         else:
-            chosen = self.DEFAULT_DB_ALIAS
+            log.debug('No alive export slaves in %s', group.name)
+            chosen = self.group_db_for_read(group)
 
-        self.context.chosen[self.state()] = chosen
+        self.context.chosen[key] = chosen
 
-        log.debug('db_for_read: %s', chosen)
+        log.debug('db_for_read: %s, export', chosen)
         return chosen
 
+    def prefer_local(self, slaves):
+        '''
+        Slaves in the zone of this node first, remote ones after them.
+        '''
+        if not self.local_aliases:
+            return slaves
+
+        local = [slave for slave in slaves if slave in self.local_aliases]
+        remote = [slave for slave in slaves if slave not in self.local_aliases]
+        return local + remote
+
+    def is_saturated(self, db_name):
+        '''
+        Slave lagging more than REPLICATED_SATURATION_LAG is used only
+        if there is no other alive slave.
+        '''
+        return self.SATURATION_LAG is not None and not self.is_fresh(db_name, self.SATURATION_LAG)
+
+    def choose_slave(self, group):
+        max_staleness = self.context.max_staleness
+        saturated = []
+
+        for slave in self.prefer_local(group.ordered_slaves()):
+            if not self.is_alive(slave, group.downtime):
+                continue
+            if max_staleness is not None and not self.is_fresh(slave, max_staleness):
+                log.debug('%s lags more than %s seconds', slave, max_staleness)
+                continue
+            if self.is_saturated(slave):
+                log.debug('%s is saturated', slave)
+                saturated.append(slave)
+                continue
+            return slave
+
+        if saturated:
+            return saturated[0]
+
+        return group.master
+
+    def alive_slaves(self, group, check_interval, measure_lag=False):
+        '''
+        Alive slaves of a group and their replication lag, checked again
+        not more often than once in check_interval seconds. Lag is
+        measured only if measure_lag is set, otherwise it is {}.
+
+        Only one thread checks slaves at a time, others keep using the
+        previous result meanwhile or wait for the first one.
+        '''
+        def is_valid(entry):
+            return (
+                entry is not None and time.time() - entry[0] < check_interval and
+                (entry[2] is not None or not measure_lag)
+            )
+
+        entry = self._alive_slaves.get(group.name)
+        if is_valid(entry):
+            return entry[1], entry[2] or {}
+
+        # Wait if there is no usable previous result
+        blocking = entry is None or (measure_lag and entry[2] is None)
+        if not self._alive_slaves_lock.acquire(blocking):
+            return entry[1], entry[2] or {}
+
+        try:
+            entry = self._alive_slaves.get(group.name)
+            if not is_valid(entry):
+                alive = [slave for slave in group.slaves if self.is_alive(slave, group.downtime)]
+                lags = dict((slave, self.get_lag(slave)) for slave in alive) if measure_lag else None
+                entry = self._alive_slaves[group.name] = (time.time(), alive, lags)
+                log.debug('alive slaves of %s: %s', group.name, ', '.join(alive))
+        finally:
+            self._alive_slaves_lock.release()
+
+        return entry[1], entry[2] or {}
+
+    def distribute_slave(self, group, check_interval):
+        # Lag is measured with alive checks, not on every read
+        max_staleness = self.context.max_staleness
+        measure_lag = max_staleness is not None or self.SATURATION_LAG is not None
+        alive, lags = self.alive_slaves(group, check_interval, measure_lag)
+
+        def lags_not_more(slave, seconds):
+            lag = lags.get(slave)
+            return lag is not None and lag <= seconds
+
+        if max_staleness is not None:
+            alive = [slave for slave in alive if lags_not_more(slave, max_staleness)]
+
+        if not alive:
+            return group.master
+
+        # Same preference as choose_slave: unsaturated slaves first, local ones among them
+        if self.SATURATION_LAG is not None:
+            alive = [slave for slave in alive if lags_not_more(slave, self.SATURATION_LAG)] or alive
+        if self.local_aliases:
+            alive = [slave for slave in alive if slave in self.local_aliases] or alive
+
+        chosen = alive[next(self._round_robin[group.name]) % len(alive)]
+
+        log.debug('db_for_read: %s, distributed', chosen)
+        return chosen
+
+    def chosen_aliases(self):
+        '''
+        Aliases used in the current state: masters of all groups in
+        master state, otherwise aliases already chosen by any group, masters
+        of groups with tables read from master and the read alias of the
+        default group. Slaves of other groups are not checked, as well as
+        slaves of the default group when reads are distributed.
+        '''
+        aliases = set(self.context.chosen.values())
+
+        if self.state() == 'master':
+            aliases.update(group.master for group in self.groups)
+        else:
+            aliases.update(self.get_table_group(table).master for table in self.context.master_tables)
+            if not self.context.distribution_stack:
+                aliases.add(self.db_for_read())
+
+        return tuple(sorted(aliases))
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        '''
+        Migrations of a model are applied only to the master of its group,
+        slaves get them by replication.
+        '''
+        if db not in self.groups_by_alias:
+            return None
+
+        if isinstance(app_label, type):  # django 1.7 passes a model
+            app_label, model_name = app_label._meta.app_label, app_label._meta.model_name
+
+        for group in self.groups[1:]:
+            if group.matches_label(app_label, model_name):
+                break
+        else:
+            group = self.default_group
+
+        return db == group.master
+
     def allow_relation(self, obj1, obj2, **hints):
+        groups = set()
         for db in (obj1._state.db, obj2._state.db):
-            if db is not None and db not in self.all_allowed_aliases:
+            if db is None:
+                continue
+            if db not in self.groups_by_alias:
                 return False
+            groups.add(self.groups_by_alias[db])
 
-        return True
+        return len(groups) <= 1
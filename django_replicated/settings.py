@@ -1,15 +1,64 @@
 # Cache backend name to store database state
 REPLICATED_CACHE_BACKEND = None
 
+# Node identity used in database state cache keys, FQDN of the host by default
+REPLICATED_NODE_NAME = None
+
 # Timeout for dead databases alive check
 REPLICATED_DATABASE_DOWNTIME = 60
 
 # List of slave database aliases. Default database is always master
 REPLICATED_DATABASE_SLAVES = []
 
-# View name to state mapping
+# Slaves dedicated to streaming reads (exports, large iterators)
+REPLICATED_EXPORT_SLAVES = []
+
+# Timeout for dead export slaves alive check, REPLICATED_DATABASE_DOWNTIME by default
+REPLICATED_EXPORT_DOWNTIME = None
+
+# Slave choosing strategy: 'random' or 'ordered' (first alive in the list)
+REPLICATED_DATABASE_BALANCING = 'random'
+
+# Additional replication groups routed by app label or "app_label.ModelName":
+#     {'billing': {'MASTER': 'billing', 'SLAVES': ['billing_slave'],
+#                  'DOWNTIME': 30, 'BALANCING': 'ordered', 'APPS': ['billing']}}
+REPLICATED_DATABASE_GROUPS = {}
+
+# Availability zone of database aliases: {'slave1': 'zone-a', ...}
+REPLICATED_DATABASE_ZONES = {}
+
+# Availability zone of this node. Slaves in the same zone are preferred
+REPLICATED_NODE_ZONE = None
+
+# Lag in seconds after which a slave is used only if there is no other
+# alive slave, None to disable
+REPLICATED_SATURATION_LAG = None
+
+# Interval in seconds between alive checks of slaves when reads are distributed
+REPLICATED_DISTRIBUTE_CHECK_INTERVAL = 10
+
+# Seconds to cache replication lag of slaves used for max staleness checks
+REPLICATED_LAG_CACHE_SECONDS = 1
+
+# View name to state mapping. State may carry max staleness in seconds
+# of slaves to use, e.g. ('slave', 30)
 REPLICATED_VIEWS_OVERRIDES = {}
 
+# Use separate connections with short timeouts for database checks
+REPLICATED_PROBE_CONNECTIONS = True
+
+# Connect timeout of probe connections in seconds
+REPLICATED_PROBE_CONNECT_TIMEOUT = 2
+
+# Statement timeout of probe connections in seconds
+REPLICATED_PROBE_STATEMENT_TIMEOUT = 2
+
+# Enable replication consistent cache of query results (querycache module)
+REPLICATED_QUERY_CACHE = False
+
+# Max life time of cached query results and write positions in seconds
+REPLICATED_QUERY_CACHE_TIMEOUT = 300
+
 # Timeout for dead databases alive check for read only flag
 REPLICATED_READ_ONLY_DOWNTIME = 20
 
@@ -22,6 +71,14 @@ REPLICATED_FORCE_MASTER_COOKIE_NAME = 'just_updated'
 # Cookie life time in seconds
 REPLICATED_FORCE_MASTER_COOKIE_MAX_AGE = 5
 
+# Store written tables in the cookie and use master only for reads of them
+# instead of the whole request
+REPLICATED_FORCE_MASTER_TABLES = False
+
+# Max number of tables stored in the cookie, the whole next request
+# uses master if more tables were written
+REPLICATED_FORCE_MASTER_MAX_TABLES = 20
+
 # Header name for forcing state switch
 REPLICATED_FORCE_STATE_HEADER = 'HTTP_X_REPLICATED_STATE'
 
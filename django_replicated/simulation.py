@@ -0,0 +1,450 @@
+# coding: utf-8
+'''
+Harness for simulating a replicated topology locally.
+
+Fakes a master/slave topology on top of local databases and drives
+``ReplicationRouter`` and ``ReplicationMiddleware`` with concurrent clients
+while injecting probe latency, probe failures, outages, flapping and
+replication lag. Reports throughput, fallback rate, time to detect a dead
+replica and time to bring it back, which helps to tune
+``REPLICATED_DATABASE_DOWNTIME`` with data rather than guesses.
+
+Usage:
+
+    python -m django_replicated.simulation --slaves 2 --duration 10 \\
+        --downtime 1 --down slave1:2:5 --flap slave2:1.5 --lag slave1:0.2
+
+When Django settings are already configured (e.g. in tests) the aliases
+of the simulated nodes must exist in ``DATABASES``.
+'''
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import json
+import logging
+import random
+import shutil
+import threading
+import time
+from functools import partial
+
+from django.conf.urls import url
+from django.http import HttpResponse, HttpResponseRedirect
+
+
+class Node(object):
+    '''
+    Simulated database node.
+
+    ``down`` is a list of ``(start, end)`` intervals in seconds since the
+    start of a run during which the node is dead. ``flap_period`` makes the
+    node alternate between alive and dead every ``flap_period`` seconds.
+    ``lag`` is the replication delay in seconds.
+    '''
+    def __init__(self, alias, probe_latency=0, failure_rate=0, down=(), flap_period=None, lag=0):
+        self.alias = alias
+        self.probe_latency = probe_latency
+        self.failure_rate = failure_rate
+        self.down = list(down)
+        self.flap_period = flap_period
+        self.lag = lag
+
+    def down_intervals(self, duration):
+        intervals = list(self.down)
+        if self.flap_period:
+            start = self.flap_period
+            while start < duration:
+                intervals.append((start, start + self.flap_period))
+                start += 2 * self.flap_period
+        return sorted(intervals)
+
+    def is_up(self, moment):
+        if self.flap_period and int(moment // self.flap_period) % 2:
+            return False
+        return not any(start <= moment < end for start, end in self.down)
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.writes = 0
+        self.reads = 0
+        self.slave_state_reads = 0
+        self.fallback_reads = 0
+        self.stale_reads = 0
+        self.dead_reads = 0
+        self.reads_by_alias = {}
+        # alias -> [(moment, is_ok)]
+        self.probes = {}
+        self.probe_time = 0.0
+        # alias -> [moment]
+        self.routed = {}
+        self.last_write = None
+
+
+class Simulation(object):
+    '''
+    Runs concurrent clients against a simulated topology.
+
+    Every client is a ``django.test.Client`` sending GET (read) and POST
+    (write) requests through ``ReplicationMiddleware``, so read-after-write
+    cookies are honoured as in a real deployment.
+    '''
+    def __init__(self, nodes, master='default', concurrency=4, duration=5.0,
+                 write_ratio=0.1, downtime=1, think_time=0):
+        self.nodes = dict((node.alias, node) for node in nodes)
+        self.master = master
+        self.concurrency = concurrency
+        self.duration = duration
+        self.write_ratio = write_ratio
+        self.downtime = downtime
+        self.think_time = think_time
+
+        self.master_node = self.nodes.setdefault(master, Node(master))
+        self.slaves = [alias for alias in self.nodes if alias != master]
+        self.stats = Stats()
+        self.started = None
+
+    def now(self):
+        return time.time() - self.started
+
+    def probe(self, connection):
+        from django.db import OperationalError
+
+        node = self.nodes[connection.alias]
+        began = time.time()
+        if node.probe_latency:
+            time.sleep(node.probe_latency)
+        moment = self.now()
+        is_ok = node.is_up(moment) and random.random() >= node.failure_rate
+
+        stats = self.stats
+        with stats.lock:
+            stats.probe_time += time.time() - began
+            stats.probes.setdefault(node.alias, []).append((moment, is_ok))
+
+        if not is_ok:
+            raise OperationalError('Simulated failure of %s' % node.alias)
+        return True
+
+    def view(self, request):
+        from django.db import connections
+        from .utils import routers
+
+        is_write = request.method == 'POST'
+        if is_write:
+            alias = routers.db_for_write()
+        else:
+            alias = routers.db_for_read()
+
+        with connections[alias].cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+        self.record(alias, is_write, routers.state())
+
+        if is_write:
+            return HttpResponseRedirect('/')
+        return HttpResponse()
+
+    def record(self, alias, is_write, state):
+        moment = self.now()
+        node = self.nodes[alias]
+        stats = self.stats
+
+        with stats.lock:
+            stats.requests += 1
+            if is_write:
+                stats.writes += 1
+                stats.last_write = moment
+                return
+
+            stats.reads += 1
+            stats.reads_by_alias[alias] = stats.reads_by_alias.get(alias, 0) + 1
+            stats.routed.setdefault(alias, []).append(moment)
+
+            if not node.is_up(moment):
+                stats.dead_reads += 1
+
+            if state == 'slave':
+                stats.slave_state_reads += 1
+                if alias == self.master:
+                    stats.fallback_reads += 1
+
+            if (
+                alias != self.master and node.lag and
+                stats.last_write is not None and moment - node.lag < stats.last_write
+            ):
+                stats.stale_reads += 1
+
+    @property
+    def urlpatterns(self):
+        return [url(r'^$', self.view)]
+
+    def client_loop(self, deadline):
+        from django.db import connections
+        from django.test import Client
+        from .dbchecker import close_probe_connections
+
+        client = Client()
+        try:
+            while time.time() < deadline:
+                if random.random() < self.write_ratio:
+                    client.post('/')
+                else:
+                    client.get('/')
+                if self.think_time:
+                    time.sleep(self.think_time)
+        finally:
+            connections.close_all()
+            close_probe_connections()
+
+    def run(self):
+        from django.test.utils import override_settings
+        from . import dbchecker
+
+        probe = self.probe
+        # Cache keys of dbchecker depend on checker name, keep them unique per run
+        checker = partial(dbchecker.check_db, _named(probe, 'simulated_probe_%x' % id(self)))
+
+        overrides = override_settings(
+            ROOT_URLCONF=self,
+            REPLICATED_DATABASE_SLAVES=self.slaves,
+            REPLICATED_DATABASE_DOWNTIME=self.downtime,
+            DATABASE_ROUTERS=['django_replicated.router.ReplicationRouter'],
+            MIDDLEWARE=['django_replicated.middleware.ReplicationMiddleware'],
+            MIDDLEWARE_CLASSES=['django_replicated.middleware.ReplicationMiddleware'],
+        )
+
+        original_checker = dbchecker.db_is_alive
+        dbchecker.db_is_alive = checker
+        try:
+            with overrides:
+                self.started = time.time()
+                deadline = self.started + self.duration
+                threads = [
+                    threading.Thread(target=self.client_loop, args=(deadline,))
+                    for _ in range(self.concurrency)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = self.now()
+        finally:
+            dbchecker.db_is_alive = original_checker
+
+        return self.report(elapsed)
+
+    def detection_times(self, alias, elapsed):
+        '''
+        Seconds from every outage start until the first failed probe
+        and from every outage end until the first read routed back.
+        '''
+        probes = self.stats.probes.get(alias, [])
+        routed = self.stats.routed.get(alias, [])
+        detect, recover, undetected = [], [], 0
+
+        for start, end in self.nodes[alias].down_intervals(elapsed):
+            if start >= elapsed:
+                continue
+            failed = [moment for moment, is_ok in probes if not is_ok and start <= moment < end]
+            if failed:
+                detect.append(failed[0] - start)
+            else:
+                undetected += 1
+
+            back = [moment for moment in routed if moment >= end]
+            if end < elapsed and back:
+                recover.append(back[0] - end)
+
+        return detect, recover, undetected
+
+    def report(self, elapsed):
+        stats = self.stats
+        probes = sum(len(results) for results in stats.probes.values())
+
+        nodes = {}
+        for alias in sorted(self.nodes):
+            detect, recover, undetected = self.detection_times(alias, elapsed)
+            nodes[alias] = {
+                'reads': stats.reads_by_alias.get(alias, 0),
+                'probes': len(stats.probes.get(alias, [])),
+                'outages_undetected': undetected,
+                'time_to_detect': _summary(detect),
+                'time_to_recover': _summary(recover),
+            }
+
+        return {
+            'duration': elapsed,
+            'downtime': self.downtime,
+            'concurrency': self.concurrency,
+            'requests': stats.requests,
+            'throughput': stats.requests / elapsed if elapsed else 0.0,
+            'writes': stats.writes,
+            'reads': stats.reads,
+            'slave_state_reads': stats.slave_state_reads,
+            'fallback_rate': _ratio(stats.fallback_reads, stats.slave_state_reads),
+            'stale_read_rate': _ratio(stats.stale_reads, stats.reads),
+            'dead_reads': stats.dead_reads,
+            'probes': probes,
+            'mean_probe_time': stats.probe_time / probes if probes else 0.0,
+            'nodes': nodes,
+        }
+
+
+def _named(func, name):
+    def wrapper(*args, **kwargs):
+        return func(*args, **kwargs)
+    wrapper.__name__ = str(name)
+    return wrapper
+
+
+def _ratio(part, whole):
+    return part / whole if whole else 0.0
+
+
+def _summary(values):
+    if not values:
+        return None
+    return {'mean': sum(values) / len(values), 'max': max(values), 'count': len(values)}
+
+
+def format_report(report):
+    lines = [
+        'duration: %.2fs, concurrency: %d, downtime: %ss' % (
+            report['duration'], report['concurrency'], report['downtime']),
+        'requests: %d (%.1f req/s), writes: %d, reads: %d' % (
+            report['requests'], report['throughput'], report['writes'], report['reads']),
+        'fallback rate: %.2f%%, stale read rate: %.2f%%, reads from dead nodes: %d' % (
+            report['fallback_rate'] * 100, report['stale_read_rate'] * 100, report['dead_reads']),
+        'probes: %d, mean probe time: %.4fs' % (report['probes'], report['mean_probe_time']),
+        '',
+        '%-12s %8s %8s %12s %12s %10s' % ('alias', 'reads', 'probes', 'detect', 'recover', 'missed'),
+    ]
+
+    def _mean(summary):
+        return '-' if summary is None else '%.3fs' % summary['mean']
+
+    for alias, node in sorted(report['nodes'].items()):
+        lines.append('%-12s %8d %8d %12s %12s %10d' % (
+            alias, node['reads'], node['probes'], _mean(node['time_to_detect']),
+            _mean(node['time_to_recover']), node['outages_undetected']))
+
+    return '\n'.join(lines)
+
+
+def _split(value, parts):
+    items = value.split(':')
+    if len(items) != parts:
+        raise argparse.ArgumentTypeError('Expected %d ":" separated values: %s' % (parts, value))
+    return [items[0]] + [float(item) for item in items[1:]]
+
+
+def build_nodes(options):
+    aliases = ['slave%d' % number for number in range(1, options.slaves + 1)]
+    nodes = dict(
+        (alias, Node(alias, probe_latency=options.probe_latency))
+        for alias in ['default'] + aliases
+    )
+
+    for alias, start, end in options.down:
+        nodes[alias].down.append((start, end))
+    for alias, period in options.flap:
+        nodes[alias].flap_period = period
+    for alias, lag in options.lag:
+        nodes[alias].lag = lag
+    for alias, rate in options.failure_rate:
+        nodes[alias].failure_rate = rate
+
+    return list(nodes.values())
+
+
+def configure(nodes):
+    '''
+    Configures Django with a sqlite database per node in a temporary
+    directory. Returns the directory to be removed by the caller or None
+    if settings are already configured.
+    '''
+    import os
+    import tempfile
+
+    import django
+    from django.conf import settings
+
+    from . import settings as replicated_settings
+
+    if settings.configured:
+        return None
+
+    directory = tempfile.mkdtemp(prefix='django_replicated_simulation_')
+    config = dict(
+        (name, value) for name, value in vars(replicated_settings).items()
+        if name.isupper()
+    )
+    config.update({
+        'DATABASES': dict(
+            (node.alias, {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(directory, '%s.sqlite3' % node.alias),
+            })
+            for node in nodes
+        ),
+        'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        'ALLOWED_HOSTS': ['*'],
+    })
+    settings.configure(**config)
+    django.setup()
+    return directory
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--slaves', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--write-ratio', type=float, default=0.1)
+    parser.add_argument('--downtime', type=float, default=1)
+    parser.add_argument('--think-time', type=float, default=0)
+    parser.add_argument('--probe-latency', type=float, default=0,
+                        help='Probe latency of every node in seconds')
+    parser.add_argument('--down', action='append', default=[], type=lambda v: _split(v, 3),
+                        metavar='ALIAS:START:END', help='Kill a node for a period of time')
+    parser.add_argument('--flap', action='append', default=[], type=lambda v: _split(v, 2),
+                        metavar='ALIAS:PERIOD', help='Toggle a node every PERIOD seconds')
+    parser.add_argument('--lag', action='append', default=[], type=lambda v: _split(v, 2),
+                        metavar='ALIAS:SECONDS', help='Replication lag of a node')
+    parser.add_argument('--failure-rate', action='append', default=[], type=lambda v: _split(v, 2),
+                        metavar='ALIAS:RATE', help='Probability of a random probe failure')
+    parser.add_argument('--json', action='store_true', help='Output report as JSON')
+    parser.add_argument('--verbose', action='store_true', help='Show errors logged by failed probes')
+    options = parser.parse_args(argv)
+
+    if not options.verbose:
+        logging.getLogger('django_replicated.dbchecker').setLevel(logging.CRITICAL)
+
+    nodes = build_nodes(options)
+    directory = configure(nodes)
+
+    try:
+        simulation = Simulation(
+            nodes,
+            concurrency=options.concurrency,
+            duration=options.duration,
+            write_ratio=options.write_ratio,
+            downtime=options.downtime,
+            think_time=options.think_time,
+        )
+        report = simulation.run()
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if options.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
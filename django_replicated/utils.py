@@ -3,6 +3,11 @@ from __future__ import unicode_literals
 
 from django import db
 
+try:
+    from django.core.signals import setting_changed
+except ImportError:  # django 1.7
+    from django.test.signals import setting_changed
+
 
 def get_object_name(obj):
     try:
@@ -12,12 +17,47 @@ def get_object_name(obj):
 
 
 class Routers(object):
+    '''
+    Proxy to attributes of the first database router having them.
+
+    Routers are looked up once per attribute, the cache is cleared when
+    DATABASE_ROUTERS setting changes. Code calling the router many times
+    can resolve it once with `routers.get_router(name)` and call it
+    directly.
+    '''
+    def __init__(self):
+        self._owners = {}
+
     def __getattr__(self, name):
+        return getattr(self.get_router(name), name)
+
+    def get_router(self, name):
+        '''
+        The first router having an attribute.
+        '''
+        try:
+            return self._owners[name]
+        except KeyError:
+            owner = self._owners[name] = self.find_router(name)
+            return owner
+
+    def find_router(self, name):
         for r in db.router.routers:
             if hasattr(r, name):
-                return getattr(r, name)
+                return r
         msg = 'Not found the router with the method "%s".' % name
         raise AttributeError(msg)
 
+    def clear(self):
+        self._owners = {}
+
 
 routers = Routers()
+
+
+def clear_routers(setting, **kwargs):
+    if setting == 'DATABASE_ROUTERS':
+        routers.clear()
+
+
+setting_changed.connect(clear_routers)
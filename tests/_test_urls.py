@@ -30,6 +30,17 @@ def just_updated_view(request):
     return HttpResponse()
 
 
+def written_tables_view(request):
+    routers.mark_written('table_one', 'table_two')
+    return HttpResponseRedirect('/')
+
+
+def master_tables_view(request):
+    response = get_response()
+    response['Master-Tables'] = ','.join(sorted(routers.context.master_tables))
+    return response
+
+
 class TestView(View):
     def get(self, request):
         response = get_response()
@@ -68,6 +79,8 @@ urlpatterns = [
     url(r'^$', view),
     url(r'^admin/auth/$', TestView.as_view()),
     url(r'^just_updated$', just_updated_view),
+    url(r'^written_tables$', written_tables_view),
+    url(r'^master_tables$', master_tables_view),
     url(r'^with_name$', view, name='view-name'),
     url(r'^as_class$', TestView.as_view()),
     url(r'^as_callable$', TestCallable()),
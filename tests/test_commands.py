@@ -0,0 +1,98 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import json
+
+import pytest
+from django.core.management import call_command
+from django.utils.six import StringIO
+from mock import patch
+
+from django_replicated.management.commands.replicated_status import Command
+
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def test_replicated_status_json():
+    stdout = StringIO()
+
+    with patch('django_replicated.dbchecker.is_marked_dead') as is_marked_dead_mock:
+        is_marked_dead_mock.side_effect = lambda checker, db_name, node: db_name == 'slave2'
+
+        call_command(Command(), queries=10, concurrency=2, json=True, stdout=stdout)
+
+    statuses = dict((status['alias'], status) for status in json.loads(stdout.getvalue()))
+
+    assert sorted(statuses) == ['default', 'slave1', 'slave2']
+    assert statuses['default']['role'] == 'master'
+    assert statuses['slave1']['role'] == 'slave'
+    assert statuses['slave1']['lag'] == 0
+    assert not statuses['slave1']['dead']
+    assert statuses['slave2']['dead']
+    assert statuses['slave1']['benchmark']['queries'] == 10
+    assert statuses['slave1']['benchmark']['errors'] == 0
+
+
+def test_replicated_status_table():
+    stdout = StringIO()
+
+    call_command(Command(), queries=0, lag=False, stdout=stdout)
+
+    lines = stdout.getvalue().splitlines()
+
+    assert lines[0].split() == ['alias', 'group', 'role', 'state', 'lag']
+    assert len(lines) == 4
+
+
+def test_replicated_status_table_read_only():
+    stdout = StringIO()
+
+    with patch('django_replicated.dbchecker.is_marked_dead') as is_marked_dead_mock:
+        is_marked_dead_mock.side_effect = lambda checker, db_name, node: (
+            checker.__name__ == 'is_writable' and db_name == 'default'
+        )
+
+        call_command(Command(), queries=0, lag=False, stdout=stdout)
+
+    states = dict(line.split()[:4:3] for line in stdout.getvalue().splitlines()[1:])
+
+    assert states == {'default': 'read-only', 'slave1': 'alive', 'slave2': 'alive'}
+
+
+def test_replicated_status_node():
+    from django_replicated.dbchecker import DEAD_MARK, get_cache_key, get_state_cache
+
+    stdout = StringIO()
+    cache_key = get_cache_key('is_alive', 'slave1', 'web1')
+    get_state_cache().set(cache_key, DEAD_MARK, 10)
+
+    try:
+        call_command(Command(), queries=0, lag=False, node='web1', json=True, stdout=stdout)
+    finally:
+        get_state_cache().delete(cache_key)
+
+    statuses = dict((status['alias'], status) for status in json.loads(stdout.getvalue()))
+
+    assert statuses['slave1']['dead']
+    assert statuses['slave1']['node'] == 'web1'
+    assert not statuses['slave2']['dead']
+
+
+def test_replicated_status_benchmark_timeouts():
+    from django_replicated import dbchecker
+
+    with patch.object(dbchecker, 'create_probe_connection', wraps=dbchecker.create_probe_connection) as create_mock:
+        call_command(Command(), queries=2, concurrency=1, lag=False, json=True, stdout=StringIO())
+
+    assert sorted(call[0][0] for call in create_mock.call_args_list) == ['default', 'slave1', 'slave2']
+
+
+def test_make_options():
+    from django_replicated.management.commands.replicated_status import make_options
+
+    options = dict((option.dest, option) for option in make_options(Command.arguments))
+
+    assert options['queries'].type == 'int'
+    assert options['lag'].action == 'store_false'
+    assert options['node'].default is None
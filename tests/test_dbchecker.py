@@ -1,11 +1,15 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import pytest
 from mock import MagicMock, patch, call
 
 from django.db import connections
 
-from django_replicated.dbchecker import cache, check_db, hostname
+from django_replicated.dbchecker import (
+    check_db, close_probe_connection, get_hostname, get_lag, get_probe_connection, get_probe_options,
+    get_state_cache, is_alive,
+)
 
 
 def test_check_success():
@@ -21,48 +25,168 @@ def test_check_retry():
 
     check_db(checker, 'default', number_of_tries=3)
 
-    checker.assert_has_calls([call(connections['default']) for _ in range(3)])
+    checker.assert_has_calls([call(get_probe_connection('default')) for _ in range(3)])
 
 
 def test_check_success_no_cache():
     checker = MagicMock(return_value=True)
 
-    with patch.object(cache, 'set') as cache_set_mock:
+    with patch.object(get_state_cache(), 'set') as cache_set_mock:
         check_db(checker, 'default', 10)
 
-        checker.assert_called_once_with(connections['default'])
+        checker.assert_called_once_with(get_probe_connection('default'))
         cache_set_mock.assert_not_called()
 
 
 def test_check_fail_set_cache():
     checker = MagicMock(return_value=False)
 
-    with patch.object(cache, 'set') as cache_set_mock:
+    with patch.object(get_state_cache(), 'set') as cache_set_mock:
         check_db(checker, 'default', 10)
 
-        checker.assert_called_once_with(connections['default'])
-        cache_set_mock.assert_called_once_with('%s:MagicMock:default' % hostname, 'dead', 10)
+        checker.assert_called_once_with(get_probe_connection('default'))
+        cache_set_mock.assert_called_once_with('%s:MagicMock:default' % get_hostname(), 'dead', 10)
 
 
 def test_check_fail_get_cache():
     checker = MagicMock(return_value=False)
 
-    with patch.object(cache, 'get') as cache_get_mock:
+    with patch.object(get_state_cache(), 'get') as cache_get_mock:
         cache_get_mock.return_value = 'dead'
 
         check_db(checker, 'default', 10)
 
-        cache_get_mock.assert_called_once_with('%s:MagicMock:default' % hostname)
+        cache_get_mock.assert_called_once_with('%s:MagicMock:default' % get_hostname())
         checker.assert_not_called()
 
 
 def test_check_fail_get_cache_force():
     checker = MagicMock(return_value=False)
 
-    with patch.object(cache, 'get') as cache_get_mock:
+    with patch.object(get_state_cache(), 'get') as cache_get_mock:
         cache_get_mock.return_value = 'dead'
 
         check_db(checker, 'default', 10, force=True)
 
         cache_get_mock.assert_not_called()
-        checker.assert_called_once_with(connections['default'])
+        checker.assert_called_once_with(get_probe_connection('default'))
+
+
+def test_node_name_setting(settings):
+    settings.REPLICATED_NODE_NAME = 'node1'
+
+    assert get_hostname() == 'node1'
+
+    with patch('socket.getfqdn') as getfqdn_mock:
+        getfqdn_mock.return_value = 'host.example.com'
+        settings.REPLICATED_NODE_NAME = None
+
+        assert get_hostname() == 'host.example.com'
+        assert get_hostname() == 'host.example.com'
+        getfqdn_mock.assert_called_once_with()
+
+
+@pytest.mark.django_db
+def test_get_lag():
+    assert get_lag('default') == 0
+
+    with patch('django_replicated.dbchecker.replication_lag') as replication_lag_mock:
+        replication_lag_mock.side_effect = Exception
+
+        assert get_lag('default') is None
+
+        with patch.object(get_state_cache(), 'set') as cache_set_mock:
+            assert get_lag('slave1', 10) is None
+
+            cache_set_mock.assert_called_once_with('%s:replication_lag:slave1' % get_hostname(), 'unknown', 10)
+
+
+def test_get_lag_cached():
+    with patch.object(get_state_cache(), 'get') as cache_get_mock:
+        cache_get_mock.return_value = 5
+
+        assert get_lag('slave1', 10) == 5
+
+        cache_get_mock.return_value = 'unknown'
+
+        assert get_lag('slave1', 10) is None
+
+
+def test_probe_connection():
+    probe = get_probe_connection('default')
+
+    assert probe is not connections['default']
+    assert probe.alias == 'default'
+    assert probe.settings_dict['OPTIONS']['timeout'] == 2
+    assert get_probe_connection('default') is probe
+
+    close_probe_connection('default')
+
+    assert get_probe_connection('default') is not probe
+
+
+def test_probe_connection_disabled(settings):
+    settings.REPLICATED_PROBE_CONNECTIONS = False
+
+    assert get_probe_connection('default') is connections['default']
+
+
+def test_probe_connection_closed_on_error():
+    probe = get_probe_connection('default')
+
+    check_db(MagicMock(side_effect=Exception), 'default')
+
+    assert get_probe_connection('default') is not probe
+
+
+@pytest.mark.django_db
+def test_probe_connection_failed_after_check():
+    from django.db import OperationalError
+
+    probe = get_probe_connection('default')
+
+    assert check_db(is_alive, 'default') is True
+    assert probe.connection is not None
+
+    # In-memory sqlite connections are never closed otherwise
+    with patch.object(probe, 'is_in_memory_db', return_value=False), \
+            patch.object(probe, 'is_usable', return_value=False), \
+            patch.object(probe, 'get_new_connection', side_effect=OperationalError):
+        assert check_db(is_alive, 'default') is False
+
+    assert check_db(is_alive, 'default') is True
+    close_probe_connection('default')
+
+
+@pytest.mark.django_db
+def test_probe_connection_max_age():
+    from django.core.signals import request_finished
+    from django_replicated.dbchecker import is_alive
+
+    probe = get_probe_connection('default')
+    assert check_db(is_alive, 'default') is True
+
+    # In-memory sqlite connections are never closed otherwise
+    with patch.object(probe, 'is_in_memory_db', return_value=False):
+        probe.close_at = None
+        request_finished.send(sender=None)
+        assert probe.connection is not None
+
+        # CONN_MAX_AGE = 0 by default
+        probe.close_at = 0
+        request_finished.send(sender=None)
+        assert probe.connection is None
+
+        assert check_db(is_alive, 'default') is True
+        probe.close_at = 0
+        assert get_probe_connection('default') is probe
+        assert probe.connection is None
+
+    close_probe_connection('default')
+
+
+def test_probe_options():
+    options = get_probe_options('postgresql', {'options': '-c search_path=app'})
+
+    assert options == {'connect_timeout': 2, 'options': '-c search_path=app -c statement_timeout=2000'}
+    assert get_probe_options('mysql', {}) == {'connect_timeout': 2, 'read_timeout': 2, 'write_timeout': 2}
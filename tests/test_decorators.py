@@ -1,5 +1,6 @@
 # coding: utf-8
 
+import pytest
 from django.test import RequestFactory
 from django.http import HttpResponse
 
@@ -17,3 +18,55 @@ def test_user_state_decorator():
     use_state('master')(_view)(request)
 
     assert routers.state() == 'master'
+
+
+@pytest.mark.django_db
+def test_distribute_reads():
+    from django_replicated.decorators import distribute_reads
+
+    @distribute_reads
+    def _task():
+        assert routers.state() == 'slave'
+        return [routers.db_for_read() for _ in range(4)]
+
+    used = _task()
+
+    assert sorted(used) == ['slave1', 'slave1', 'slave2', 'slave2']
+    assert routers.state() == 'master'
+
+
+@pytest.mark.django_db
+def test_distribute_reads_recheck():
+    from mock import patch
+    from django.db import router
+    from django_replicated.decorators import distribute_reads
+
+    with distribute_reads(check_interval=0):
+        with patch.object(router.routers[0], 'is_alive') as is_alive_mock:
+            is_alive_mock.return_value = False
+
+            assert routers.db_for_read() == 'default'
+            assert is_alive_mock.call_count == 2
+
+
+@pytest.mark.django_db
+def test_distribute_reads_write():
+    from django_replicated.decorators import distribute_reads
+
+    with distribute_reads():
+        assert routers.db_for_write() == 'default'
+
+        routers.use_state('master')
+        assert routers.db_for_read() == 'default'
+        routers.revert()
+
+
+def test_export_reads():
+    from django_replicated.decorators import export_reads
+
+    with export_reads():
+        assert routers.state() == 'slave'
+        assert routers.context.export_stack == [True]
+
+    assert routers.state() == 'master'
+    assert routers.context.export_stack == []
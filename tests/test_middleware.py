@@ -179,3 +179,146 @@ def test_atomic_view(client, url):
             atomic.assert_called_once_with(using='default')
             assert response['Default-Non-Atomic'] == ''
             assert response['Non-Atomic'] == ','.join(sorted({'default', 'slave1', 'slave2'} - {response['DB-Used']}))
+
+
+def test_non_atomic_dbs_per_thread():
+    import threading
+    from django_replicated.middleware import NonAtomicDbs
+
+    def _view(request):
+        pass
+
+    non_atomic_dbs = NonAtomicDbs.install(_view)
+    assert NonAtomicDbs.install(_view) is non_atomic_dbs
+    assert _view._non_atomic_requests is non_atomic_dbs
+
+    non_atomic_dbs.activate('slave1')
+
+    seen = {}
+
+    def _other_thread():
+        non_atomic_dbs.activate('slave2')
+        seen['other'] = set(_view._non_atomic_requests)
+
+    thread = threading.Thread(target=_other_thread)
+    thread.start()
+    thread.join()
+
+    assert seen['other'] == {'default', 'slave1'}
+    assert set(_view._non_atomic_requests) == {'default', 'slave2'}
+    assert non_atomic_dbs.for_aliases('slave1') is non_atomic_dbs.for_aliases('slave1')
+
+
+@pytest.fixture
+def known_tables():
+    # Tables of models, apps of test models are not installed
+    router = routers.get_router('state')
+    groups_by_table = {'table_one': router.default_group, 'table_two': router.default_group}
+    with patch.object(router, '_groups_by_table', groups_by_table):
+        yield
+
+
+def test_force_master_tables_cookie(client, known_tables):
+    with override_settings(REPLICATED_FORCE_MASTER_TABLES=True):
+        response = client.post('/written_tables')
+
+        assert response.cookies[settings.REPLICATED_FORCE_MASTER_COOKIE_NAME].value == 'table_one,table_two'
+
+        response = client.get('/master_tables')
+
+        assert response['Router-Used'] == 'slave'
+        assert response['Master-Tables'] == 'table_one,table_two'
+        assert response.cookies[settings.REPLICATED_FORCE_MASTER_COOKIE_NAME].value == ''
+
+
+def test_force_master_tables_unknown(client, known_tables):
+    router = routers.get_router('state')
+    cookie = ','.join(['table_one'] + ['unknown%d' % number for number in range(30)])
+    client.cookies[settings.REPLICATED_FORCE_MASTER_COOKIE_NAME] = cookie
+
+    with override_settings(REPLICATED_FORCE_MASTER_TABLES=True):
+        response = client.get('/master_tables')
+
+    assert response['Master-Tables'] == 'table_one'
+    assert sorted(router._groups_by_table) == ['table_one', 'table_two']
+
+
+def test_force_master_tables_too_many(client, known_tables):
+    with override_settings(REPLICATED_FORCE_MASTER_TABLES=True, REPLICATED_FORCE_MASTER_MAX_TABLES=1):
+        response = client.post('/written_tables')
+
+        assert response.cookies[settings.REPLICATED_FORCE_MASTER_COOKIE_NAME].value == 'true'
+
+
+def test_force_master_tables_no_writes(client):
+    with override_settings(REPLICATED_FORCE_MASTER_TABLES=True):
+        response = client.post('/')
+
+        assert response.cookies[settings.REPLICATED_FORCE_MASTER_COOKIE_NAME].value == 'true'
+
+        response = client.get('/')
+
+        assert response['Router-Used'] == 'master'
+
+
+@pytest.mark.parametrize('lag,used', [(5, 'default'), (0.5, None)])
+def test_replicated_middleware_max_staleness_override(client, settings, lag, used):
+    settings.REPLICATED_VIEWS_OVERRIDES = {'/': ('slave', 1)}
+
+    with patch('django_replicated.dbchecker.get_lag') as get_lag_mock:
+        get_lag_mock.return_value = lag
+
+        response = client.get('/')
+
+    assert response['Router-Used'] == 'slave'
+    if used is None:
+        assert response['DB-Used'] in ('slave1', 'slave2')
+    else:
+        assert response['DB-Used'] == used
+
+
+def test_use_state_max_staleness(_request):
+    from django.http import HttpResponse
+    from django_replicated.decorators import use_state
+
+    @use_state(forced_state='slave', max_staleness=10)
+    def _view(request):
+        response = HttpResponse()
+        response['Max-Staleness'] = routers.context.max_staleness
+        return response
+
+    assert _view(_request)['Max-Staleness'] == '10'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_query_cache_records_writes(client):
+    with override_settings(REPLICATED_QUERY_CACHE=True):
+        with patch('django_replicated.querycache.record_writes') as record_writes_mock:
+            client.post('/written_tables')
+
+            record_writes_mock.assert_called_once_with(['table_one', 'table_two'])
+
+            client.get('/')
+
+            assert record_writes_mock.call_count == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_query_cache_records_writes_after_commit(_request):
+    from django.db import transaction
+    from django.http import HttpResponse
+    from django_replicated.decorators import use_master
+
+    @use_master
+    def _view(request):
+        routers.mark_written('table_one')
+        return HttpResponse()
+
+    with override_settings(REPLICATED_QUERY_CACHE=True):
+        with patch('django_replicated.querycache.record_writes') as record_writes_mock:
+            with transaction.atomic():
+                _view(_request)
+
+                record_writes_mock.assert_not_called()
+
+            record_writes_mock.assert_called_once_with(['table_one'])
@@ -0,0 +1,153 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import pytest
+from mock import patch
+
+from django.db import connections, models
+
+from django_replicated import querycache
+from django_replicated.utils import routers
+
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+class CachedModel(models.Model):
+    name = models.CharField(max_length=10)
+
+    class Meta:
+        app_label = 'django_replicated'
+
+
+@pytest.fixture
+def table(settings):
+    settings.REPLICATED_QUERY_CACHE = True
+
+    for alias in ('default', 'slave1', 'slave2'):
+        with connections[alias].schema_editor() as editor:
+            editor.create_model(CachedModel)
+
+    yield CachedModel._meta.db_table
+
+    for alias in ('default', 'slave1', 'slave2'):
+        with connections[alias].schema_editor() as editor:
+            editor.delete_model(CachedModel)
+
+    querycache.dbchecker.get_state_cache().clear()
+
+
+def insert(name):
+    for alias in ('slave1', 'slave2'):
+        with connections[alias].cursor() as cursor:
+            cursor.execute('INSERT INTO %s (name) VALUES (%%s)' % CachedModel._meta.db_table, [name])
+
+
+def names():
+    # Model instances can't be unpickled, the app is not installed
+    return querycache.cached_query(CachedModel.objects.order_by('name').values_list('name', flat=True))
+
+
+def test_cached_query(table):
+    routers.init('slave')
+    insert('a')
+
+    with patch.object(querycache, 'get_position') as get_position_mock:
+        get_position_mock.return_value = 10
+
+        assert names() == ['a']
+
+        insert('b')
+
+        # Served from cache, no writes after position 10 recorded
+        assert names() == ['a']
+
+        # Write at position 20 is not yet replicated at position 10
+        get_position_mock.return_value = 20
+        querycache.record_writes([table])
+
+        assert names() == ['a', 'b']
+
+        # Result read at 20 is consistent with the write
+        insert('c')
+
+        assert names() == ['a', 'b']
+
+
+def test_cached_query_unknown_position(table):
+    routers.init('slave')
+    insert('a')
+
+    with patch.object(querycache, 'get_position') as get_position_mock:
+        get_position_mock.return_value = None
+
+        assert names() == ['a']
+
+        insert('b')
+
+        assert names() == ['a', 'b']
+
+
+def test_record_writes_concurrent(table):
+    import threading
+
+    cache = querycache.dbchecker.get_state_cache()
+    write_key = querycache.get_write_key('default', table)
+    positions = {'older': 20, 'newer': 30}
+    get_many = cache.get_many
+
+    def concurrent_write(keys):
+        # The newer write is recorded while the older one is between read and update
+        current = get_many(keys)
+        if threading.current_thread().name == 'older':
+            thread = threading.Thread(target=querycache.record_writes, args=([table],), name='newer')
+            thread.start()
+            thread.join(0.2)
+            threads.append(thread)
+        return current
+
+    threads = []
+    def get_position(db_name):
+        return positions[threading.current_thread().name]
+
+    with patch.object(querycache, 'get_position', side_effect=get_position):
+        with patch.object(cache, 'get_many', side_effect=concurrent_write):
+            older = threading.Thread(target=querycache.record_writes, args=([table],), name='older')
+            older.start()
+            older.join()
+            threads[0].join()
+
+    assert cache.get(write_key) == 30
+
+
+def test_distribute_reads_records_writes(table):
+    from django_replicated.decorators import distribute_reads
+
+    routers.init('slave')
+    routers.mark_written('request_table')
+
+    with patch.object(querycache, 'record_writes') as record_writes_mock:
+        with distribute_reads():
+            routers.mark_written(table)
+
+        record_writes_mock.assert_called_once_with([table])
+
+    assert routers.written_tables() == frozenset(['request_table'])
+    routers.reset()
+
+
+def test_cached_query_master_state(table):
+    routers.init('master')
+
+    with patch.object(querycache, 'get_position') as get_position_mock:
+        assert names() == []
+
+        get_position_mock.assert_not_called()
+
+
+def test_parse_positions():
+    from django_replicated.dbchecker import parse_mysql_position, parse_pg_lsn
+
+    assert parse_pg_lsn('16/B374D848') == 0x16B374D848
+    assert parse_mysql_position('mysql-bin.000002', 120) == (2 << 32) + 120
+    assert parse_mysql_position('mysql-bin.000002', 120) > parse_mysql_position('mysql-bin.000001', 5000)
@@ -61,3 +61,334 @@ def test_router_allow_relation(model):
     obj2._state.db = 'slave2'
 
     assert django_router.allow_relation(obj1, obj2)
+
+
+@pytest.fixture
+def grouped_router(settings):
+    settings.REPLICATED_DATABASE_GROUPS = {
+        'billing': {
+            'MASTER': 'billing',
+            'SLAVES': ['billing_slave'],
+            'DOWNTIME': 5,
+            'APPS': ['billing'],
+        },
+    }
+    return ReplicationRouter()
+
+
+@pytest.fixture
+def billing_model():
+    class _BillingModel(models.Model):
+        class Meta:
+            app_label = 'billing'
+
+    return _BillingModel
+
+
+def test_router_group_db_for_write(grouped_router, model, billing_model):
+    assert grouped_router.db_for_write(model) == db.DEFAULT_DB_ALIAS
+    assert grouped_router.db_for_write(billing_model) == 'billing'
+    assert grouped_router.db_for_write(None, instance=billing_model()) == 'billing'
+
+
+def test_router_group_db_for_read(grouped_router, model, billing_model):
+    grouped_router.use_state('slave')
+
+    with mock.patch.object(grouped_router, 'is_alive') as is_alive_mock:
+        is_alive_mock.return_value = True
+
+        assert grouped_router.db_for_read(billing_model) == 'billing_slave'
+        is_alive_mock.assert_called_once_with('billing_slave', 5)
+
+        is_alive_mock.return_value = False
+        assert grouped_router.db_for_read(model) == db.DEFAULT_DB_ALIAS
+
+    assert grouped_router.chosen_aliases() == ('billing_slave', db.DEFAULT_DB_ALIAS)
+
+
+def test_router_group_chosen_aliases_unused_group(grouped_router, model):
+    grouped_router.use_state('slave')
+
+    with mock.patch.object(grouped_router, 'is_alive') as is_alive_mock:
+        is_alive_mock.return_value = True
+
+        assert grouped_router.chosen_aliases() in (('slave1',), ('slave2',))
+        assert 'billing_slave' not in [call[0][0] for call in is_alive_mock.call_args_list]
+
+        with mock.patch('django.apps.apps.get_models', return_value=[model]):
+            grouped_router.set_master_tables([model._meta.db_table])
+        assert db.DEFAULT_DB_ALIAS in grouped_router.chosen_aliases()
+
+
+def test_router_group_chosen_aliases_master(grouped_router):
+    with mock.patch.object(grouped_router, 'is_alive') as is_alive_mock:
+        assert grouped_router.chosen_aliases() == ('billing', db.DEFAULT_DB_ALIAS)
+        is_alive_mock.assert_not_called()
+
+
+def test_router_chosen_aliases_distributed(router):
+    router.use_state('slave')
+    router.enable_distribution()
+
+    with mock.patch.object(router, 'is_alive') as is_alive_mock:
+        assert router.chosen_aliases() == ()
+        is_alive_mock.assert_not_called()
+
+
+def test_router_group_table_group(grouped_router, model, billing_model):
+    grouped_router.mark_written(billing_model._meta.db_table)
+
+    # Apps of test models are not installed
+    with mock.patch('django.apps.apps.get_models', return_value=[model, billing_model]):
+        assert grouped_router.get_table_group(billing_model._meta.db_table).name == 'billing'
+        assert grouped_router.get_table_group(model._meta.db_table).name == 'default'
+        assert grouped_router.get_table_group('raw_table').name == 'default'
+
+
+def test_router_group_allow_migrate(grouped_router, billing_model):
+    assert grouped_router.allow_migrate('billing', 'billing') is True
+    assert grouped_router.allow_migrate(db.DEFAULT_DB_ALIAS, 'billing') is False
+    assert grouped_router.allow_migrate('billing_slave', 'billing') is False
+    assert grouped_router.allow_migrate(db.DEFAULT_DB_ALIAS, 'auth', 'user') is True
+    assert grouped_router.allow_migrate('billing', 'auth', 'user') is False
+    assert grouped_router.allow_migrate('slave1', 'auth', 'user') is False
+    assert grouped_router.allow_migrate('unknown', 'auth', 'user') is None
+    assert grouped_router.allow_migrate('billing', billing_model) is True
+
+
+def test_router_group_allow_migrate_models(settings):
+    settings.REPLICATED_DATABASE_GROUPS = {
+        'billing': {'MASTER': 'billing', 'MODELS': ['users.Payment']},
+    }
+    router = ReplicationRouter()
+
+    assert router.allow_migrate('billing', 'users', 'payment') is True
+    assert router.allow_migrate('billing', 'users', 'user') is False
+    assert router.allow_migrate(db.DEFAULT_DB_ALIAS, 'users') is True
+
+
+def test_router_group_default_in_settings(settings):
+    from django.core.exceptions import ImproperlyConfigured
+
+    settings.REPLICATED_DATABASE_GROUPS = {'default': {'MASTER': 'other'}}
+
+    with pytest.raises(ImproperlyConfigured):
+        ReplicationRouter()
+
+
+def test_router_group_allow_relation(grouped_router, model, billing_model):
+    obj1 = model()
+    obj1._state.db = db.DEFAULT_DB_ALIAS
+    obj2 = billing_model()
+    obj2._state.db = 'billing_slave'
+    obj3 = billing_model()
+    obj3._state.db = 'billing'
+
+    assert not grouped_router.allow_relation(obj1, obj2)
+    assert grouped_router.allow_relation(obj2, obj3)
+
+
+def test_router_group_improperly_configured(settings):
+    from django.core.exceptions import ImproperlyConfigured
+
+    settings.REPLICATED_DATABASE_GROUPS = {'billing': {'SLAVES': ['slave2']}}
+
+    with pytest.raises(ImproperlyConfigured):
+        ReplicationRouter()
+
+
+def test_router_written_tables(router, model):
+    router.db_for_write(model)
+    router.mark_written('raw_table')
+
+    assert router.written_tables() == {model._meta.db_table, 'raw_table'}
+
+    router.db_for_read(model)
+    router.reset()
+
+    assert router.written_tables() == set()
+
+
+def test_router_master_tables(router, model):
+    router.use_state('slave')
+    # Apps of test models are not installed
+    with mock.patch('django.apps.apps.get_models', return_value=[model]):
+        router.set_master_tables([model._meta.db_table, 'unknown_table'])
+
+    assert router.context.master_tables == frozenset([model._meta.db_table])
+
+    assert router.db_for_read(model) == db.DEFAULT_DB_ALIAS
+    assert router.db_for_read() in ('slave1', 'slave2')
+
+
+def test_router_db_for_read_max_staleness(router, model):
+    router.use_state('slave')
+    router.set_max_staleness(1)
+
+    with mock.patch.object(router, 'is_fresh') as is_fresh_mock:
+        is_fresh_mock.side_effect = lambda db_name, max_staleness: db_name == 'slave2'
+
+        assert router.db_for_read(model) == 'slave2'
+
+    router.reset()
+    router.use_state('slave')
+    router.set_max_staleness(1)
+
+    with mock.patch.object(router, 'is_fresh') as is_fresh_mock:
+        is_fresh_mock.return_value = False
+
+        assert router.db_for_read(model) == db.DEFAULT_DB_ALIAS
+
+
+@pytest.fixture
+def zoned_router(settings):
+    settings.REPLICATED_DATABASE_ZONES = {'slave1': 'zone-a', 'slave2': 'zone-b'}
+    settings.REPLICATED_NODE_ZONE = 'zone-b'
+    return ReplicationRouter()
+
+
+def test_router_prefers_local_zone(zoned_router, model):
+    zoned_router.use_state('slave')
+
+    with mock.patch.object(zoned_router, 'is_alive') as is_alive_mock:
+        is_alive_mock.return_value = True
+
+        for _ in range(5):
+            zoned_router.context.chosen = {}
+            assert zoned_router.db_for_read(model) == 'slave2'
+
+
+def test_router_remote_zone_fallback(zoned_router, model):
+    zoned_router.use_state('slave')
+
+    with mock.patch.object(zoned_router, 'is_alive') as is_alive_mock:
+        is_alive_mock.side_effect = lambda db_name, downtime: db_name != 'slave2'
+
+        assert zoned_router.db_for_read(model) == 'slave1'
+
+
+def test_router_saturated_local_zone(zoned_router, model):
+    zoned_router.SATURATION_LAG = 5
+    zoned_router.use_state('slave')
+
+    with mock.patch.object(zoned_router, 'is_alive') as is_alive_mock:
+        is_alive_mock.return_value = True
+
+        with mock.patch.object(zoned_router, 'is_fresh') as is_fresh_mock:
+            is_fresh_mock.side_effect = lambda db_name, max_staleness: db_name != 'slave2'
+
+            assert zoned_router.db_for_read(model) == 'slave1'
+
+        zoned_router.context.chosen = {}
+
+        with mock.patch.object(zoned_router, 'is_fresh') as is_fresh_mock:
+            is_fresh_mock.return_value = False
+
+            assert zoned_router.db_for_read(model) == 'slave2'
+
+
+def test_router_distributed_saturated_local_zone(zoned_router, model):
+    zoned_router.SATURATION_LAG = 5
+    zoned_router.use_state('slave')
+    zoned_router.enable_distribution(check_interval=60)
+
+    with mock.patch.object(zoned_router, 'is_alive') as is_alive_mock:
+        is_alive_mock.return_value = True
+
+        with mock.patch.object(zoned_router, 'get_lag') as get_lag_mock:
+            get_lag_mock.side_effect = lambda db_name: 10 if db_name == 'slave2' else 0
+
+            assert [zoned_router.db_for_read(model) for _ in range(3)] == ['slave1'] * 3
+            # Lag is measured with alive checks, not on every read
+            assert get_lag_mock.call_count == 2
+
+        zoned_router._alive_slaves = {}
+
+        with mock.patch.object(zoned_router, 'get_lag') as get_lag_mock:
+            get_lag_mock.return_value = None
+
+            assert [zoned_router.db_for_read(model) for _ in range(3)] == ['slave2'] * 3
+
+
+def test_router_distributed_max_staleness(router, model):
+    router.use_state('slave')
+    router.enable_distribution(check_interval=60)
+
+    with mock.patch.object(router, 'get_lag') as get_lag_mock:
+        get_lag_mock.side_effect = lambda db_name: 10 if db_name == 'slave2' else 0
+
+        assert [router.db_for_read(model) for _ in range(2)] in (['slave1', 'slave2'], ['slave2', 'slave1'])
+        get_lag_mock.assert_not_called()
+
+        # Lag wasn't measured, slaves are checked again
+        router.set_max_staleness(5)
+        assert [router.db_for_read(model) for _ in range(3)] == ['slave1'] * 3
+        assert get_lag_mock.call_count == 2
+
+
+@pytest.fixture
+def export_router(settings):
+    settings.REPLICATED_EXPORT_SLAVES = ['export1']
+    settings.REPLICATED_EXPORT_DOWNTIME = 5
+    return ReplicationRouter()
+
+
+def test_router_export_hint(export_router, model):
+    export_router.use_state('slave')
+
+    with mock.patch.object(export_router, 'is_alive') as is_alive_mock:
+        is_alive_mock.return_value = True
+
+        assert export_router.db_for_read(model, export=True) == 'export1'
+        is_alive_mock.assert_called_once_with('export1', 5)
+
+        assert export_router.db_for_read(model) in ('slave1', 'slave2')
+
+
+def test_router_export_state(export_router, model):
+    export_router.enable_export()
+
+    with mock.patch.object(export_router, 'is_alive') as is_alive_mock:
+        is_alive_mock.return_value = True
+
+        assert export_router.db_for_read(model) == db.DEFAULT_DB_ALIAS
+
+        export_router.use_state('slave')
+
+        assert export_router.db_for_read(model) == 'export1'
+
+
+def test_router_export_fallback(export_router, model):
+    export_router.use_state('slave')
+
+    with mock.patch.object(export_router, 'is_alive') as is_alive_mock:
+        is_alive_mock.side_effect = lambda db_name, downtime: db_name != 'export1'
+
+        assert export_router.db_for_read(model, export=True) in ('slave1', 'slave2')
+
+
+def test_router_alive_slaves_single_check(router):
+    import threading
+
+    group = router.default_group
+    checking = threading.Event()
+    release = threading.Event()
+
+    def slow_is_alive(db_name, downtime=None):
+        checking.set()
+        release.wait(5)
+        return True
+
+    router.alive_slaves(group, 0)
+
+    with mock.patch.object(router, 'is_alive', side_effect=slow_is_alive) as is_alive_mock:
+        thread = threading.Thread(target=router.alive_slaves, args=(group, 0))
+        thread.start()
+        checking.wait(5)
+
+        # Another thread keeps the previous result instead of checking
+        assert router.alive_slaves(group, 0) == (['slave1', 'slave2'], {})
+        release.set()
+        thread.join()
+
+    assert is_alive_mock.call_count == 2
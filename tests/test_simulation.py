@@ -0,0 +1,47 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import pytest
+
+from django_replicated.simulation import Node, Simulation
+
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def _simulation(*nodes, **kwargs):
+    kwargs.setdefault('concurrency', 2)
+    kwargs.setdefault('duration', 0.3)
+    return Simulation(nodes, **kwargs)
+
+
+def test_node_schedule():
+    node = Node('slave1', down=[(1, 2)], flap_period=0.5)
+
+    assert node.is_up(0.2)
+    assert not node.is_up(0.7)
+    assert not node.is_up(1.2)
+    assert node.down_intervals(2) == [(0.5, 1.0), (1, 2), (1.5, 2.0)]
+
+
+def test_simulation_healthy():
+    report = _simulation(Node('slave1'), Node('slave2'), write_ratio=0).run()
+
+    assert report['requests'] > 0
+    assert report['fallback_rate'] == 0
+    assert report['nodes']['default']['reads'] == 0
+
+
+def test_simulation_all_slaves_dead():
+    report = _simulation(
+        Node('slave1', down=[(0, 10)]),
+        Node('slave2', down=[(0, 10)]),
+        write_ratio=0,
+        downtime=10,
+    ).run()
+
+    assert report['fallback_rate'] == 1
+    assert report['dead_reads'] == 0
+    assert report['nodes']['slave1']['time_to_detect']['mean'] < 0.3
+    # Dead mark is cached for downtime, so slave is probed once per client at most
+    assert report['nodes']['slave1']['probes'] <= 2
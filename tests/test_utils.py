@@ -0,0 +1,78 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import pytest
+from mock import patch
+
+from django import db
+from django.test.utils import override_settings
+
+from django_replicated.router import ReplicationRouter
+from django_replicated.utils import Routers, routers
+
+
+class _OtherRouter(object):
+    def db_for_read(self, model, **hints):
+        return None
+
+
+def test_routers_resolve_once():
+    proxy = Routers()
+
+    with patch.object(proxy, 'find_router', wraps=proxy.find_router) as find_router_mock:
+        proxy.state()
+        proxy.state()
+        assert proxy.all_allowed_aliases == ['default', 'slave1', 'slave2']
+        assert proxy.all_allowed_aliases == ['default', 'slave1', 'slave2']
+
+        assert find_router_mock.call_count == 2
+
+    assert proxy.get_router('state') is db.router.routers[0]
+    assert 'state' not in vars(proxy)
+
+
+def test_routers_patched_router():
+    router = routers.get_router('db_for_read')
+
+    with patch.object(router, 'db_for_read', return_value='patched'):
+        assert routers.db_for_read() == 'patched'
+
+    assert routers.db_for_read() == 'default'
+
+
+def test_routers_context_per_thread():
+    import threading
+
+    routers.init('slave')
+    seen = {}
+
+    def _other_thread():
+        seen['state'] = routers.state()
+        seen['stack'] = list(routers.context.state_stack)
+
+    thread = threading.Thread(target=_other_thread)
+    thread.start()
+    thread.join()
+
+    assert seen == {'state': 'master', 'stack': []}
+    assert routers.state() == 'slave'
+
+    routers.reset()
+
+
+def test_routers_override_settings():
+    routers.state()
+    replication_router = routers.get_router('state')
+
+    with override_settings(DATABASE_ROUTERS=['tests.test_utils._OtherRouter',
+                                             'django_replicated.router.ReplicationRouter']):
+        assert isinstance(routers.db_for_read.__self__, _OtherRouter)
+        assert routers.state.__self__ is not replication_router
+
+    assert isinstance(routers.db_for_read.__self__, ReplicationRouter)
+    assert routers.state.__self__ is db.router.routers[0]
+
+
+def test_routers_missing_attribute():
+    with pytest.raises(AttributeError):
+        routers.missing_method